@@ -1,7 +1,40 @@
 import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import base64
+import contextvars
+import datetime
+import email.utils
+import functools
+import hashlib
+import importlib.util
+import io
 import json
-from typing import Optional, Dict, Any
+import math
+import random
+import re
+import shutil
+import stat
+import tempfile
+import time
+import unicodedata
+import urllib.parse
+import urllib.request
+from typing import (
+    Optional,
+    Dict,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+)
 from pydantic import BaseModel, Field, AnyUrl
 import httpx
 
@@ -32,6 +65,174 @@ TOKEN_ENDPOINT = "/OAuth2/Token"
 BIOMETRIA_CONSULTAR_ENDPOINT = "/Biometria/Consultar"
 BIOMETRIA_ENVIAR_ENDPOINT = "/Biometria/Enviar"
 
+# Margem (em segundos) antes do expires_in em que o token em cache é renovado
+TOKEN_EXPIRY_MARGIN = int(os.getenv("ACERTPIX_TOKEN_EXPIRY_MARGIN", "60"))
+# Validade assumida quando a API de Token não informa expires_in
+TOKEN_DEFAULT_EXPIRES_IN = 300
+# Arquivo opcional para compartilhar o token entre processos (vazio = desativado)
+TOKEN_CACHE_FILE = os.getenv("ACERTPIX_TOKEN_CACHE_FILE", "")
+
+# Pool de conexões do cliente HTTP compartilhado
+HTTP_MAX_CONNECTIONS = int(os.getenv("ACERTPIX_HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("ACERTPIX_HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")
+)
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("ACERTPIX_HTTP_KEEPALIVE_EXPIRY", "30"))
+# HTTP/2 opcional (requer o pacote h2: pip install "httpx[http2]")
+HTTP2 = os.getenv("ACERTPIX_HTTP2", "false").lower() == "true"
+
+
+def _ler_timeout(familia: str, padrao: Dict[str, float]) -> Dict[str, float]:
+    """
+    Lê ACERTPIX_TIMEOUT_<FAMILIA> no formato "connect=5,read=30,write=30,pool=5"
+    (fases omitidas mantêm o padrão) ou um único número para todas as fases.
+    """
+    variavel = f"ACERTPIX_TIMEOUT_{familia.upper()}"
+    valor = os.getenv(variavel, "").strip()
+    if not valor:
+        return dict(padrao)
+
+    try:
+        if "=" not in valor:
+            return dict.fromkeys(padrao, float(valor))
+
+        timeout = dict(padrao)
+        for parte in valor.split(","):
+            fase, _, segundos = parte.partition("=")
+            fase = fase.strip().lower()
+            if fase not in timeout:
+                raise ValueError(f"fase desconhecida '{fase}'")
+            timeout[fase] = float(segundos)
+        return timeout
+    except ValueError as e:
+        print(f"AVISO:    {variavel} inválido ({e}), usando o padrão")
+        return dict(padrao)
+
+
+# Timeouts (segundos) por família de endpoint e fase da requisição
+HTTP_TIMEOUTS = {
+    familia: _ler_timeout(familia, padrao)
+    for familia, padrao in {
+        "token": {"connect": 5.0, "read": 10.0, "write": 10.0, "pool": 5.0},
+        "consultar": {"connect": 5.0, "read": 15.0, "write": 10.0, "pool": 5.0},
+        "obter_laudo": {"connect": 5.0, "read": 30.0, "write": 10.0, "pool": 5.0},
+        "enviar": {"connect": 5.0, "read": 60.0, "write": 60.0, "pool": 10.0},
+        "obter_pdf": {"connect": 5.0, "read": 60.0, "write": 10.0, "pool": 5.0},
+    }.items()
+}
+# Prazo total de cada ferramenta (token + requisição principal); 0 desativa
+TOOL_DEADLINE = float(os.getenv("ACERTPIX_TOOL_DEADLINE", "120"))
+
+# Retentativas de chamadas idempotentes (GETs e token) em falhas transitórias
+RETRY_MAX_ATTEMPTS = max(int(os.getenv("ACERTPIX_RETRY_MAX_ATTEMPTS", "3")), 1)
+RETRY_BACKOFF_BASE = float(os.getenv("ACERTPIX_RETRY_BACKOFF_BASE", "0.5"))
+RETRY_BACKOFF_MAX = float(os.getenv("ACERTPIX_RETRY_BACKOFF_MAX", "8"))
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# Circuit breaker por família de endpoint (/Score, /Lite, /OAuth2/Token...)
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("ACERTPIX_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("ACERTPIX_BREAKER_RESET_TIMEOUT", "30"))
+BREAKER_HALF_OPEN_MAX_CALLS = int(os.getenv("ACERTPIX_BREAKER_HALF_OPEN_MAX_CALLS", "1"))
+
+# Limite de taxa (token bucket) das chamadas à API, em requisições por segundo;
+# envios (cobrados) e consultas têm orçamentos separados. 0 = sem limite
+RATE_LIMIT_ENVIAR = float(os.getenv("ACERTPIX_RATE_LIMIT_ENVIAR", "0"))
+RATE_BURST_ENVIAR = float(os.getenv("ACERTPIX_RATE_BURST_ENVIAR", "1"))
+RATE_LIMIT_CONSULTA = float(os.getenv("ACERTPIX_RATE_LIMIT_CONSULTA", "0"))
+RATE_BURST_CONSULTA = float(os.getenv("ACERTPIX_RATE_BURST_CONSULTA", "5"))
+# Espera máxima na fila do limite de taxa antes de recusar a chamada
+RATE_LIMIT_MAX_WAIT = float(os.getenv("ACERTPIX_RATE_LIMIT_MAX_WAIT", "10"))
+
+# Controle de admissão dos envios: quantidade simultânea e bytes de imagens
+# (em base64) em envio ao mesmo tempo
+UPLOAD_MAX_CONCURRENT = max(int(os.getenv("ACERTPIX_UPLOAD_MAX_CONCURRENT", "4")), 1)
+UPLOAD_MAX_BYTES = int(os.getenv("ACERTPIX_UPLOAD_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Tamanho dos blocos lidos das imagens ao gerar o base64 (múltiplo de 3, para
+# que cada bloco codificado não tenha padding no meio do campo)
+BASE64_CHUNK_SIZE = max(int(os.getenv("ACERTPIX_BASE64_CHUNK_SIZE", str(192 * 1024))) // 3, 1) * 3
+
+# Tamanho dos trechos gravados em disco nos downloads de PDF
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# Retomadas de um download de PDF interrompido: a partir do byte já gravado
+# (Range/If-Range) quando a API aceita, senão um novo download completo
+DOWNLOAD_MAX_RESUMES = max(int(os.getenv("ACERTPIX_DOWNLOAD_MAX_RESUMES", "3")), 0)
+
+# Tamanho máximo do PDF devolvido como conteúdo na resposta da ferramenta
+# (retornarConteudo), lido em memória sem passar pelo disco
+PDF_EMBED_MAX_BYTES = int(os.getenv("ACERTPIX_PDF_EMBED_MAX_BYTES", str(20 * 1024 * 1024)))
+
+# Pré-processamento opcional das imagens antes do envio (requer o extra
+# [imagens], com o Pillow): aplica a orientação EXIF, reduz para a dimensão
+# máxima e recomprime em JPEG
+IMAGE_PREPROCESS = os.getenv("ACERTPIX_IMAGE_PREPROCESS", "false").lower() == "true"
+IMAGE_MAX_DIMENSION = int(os.getenv("ACERTPIX_IMAGE_MAX_DIMENSION", "2000"))
+IMAGE_JPEG_QUALITY = int(os.getenv("ACERTPIX_IMAGE_JPEG_QUALITY", "85"))
+IMAGE_PREPROCESS_WORKERS = max(
+    int(os.getenv("ACERTPIX_IMAGE_PREPROCESS_WORKERS", str(min(os.cpu_count() or 1, 4)))), 1
+)
+
+# Cache LRU das imagens já preparadas (pré-processadas e em base64), por
+# arquivo: dispositivo, inode, data de modificação e tamanho; 0 desativa.
+# Imagens maiores que 1/4 do limite não entram no cache e seguem em streaming
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("ACERTPIX_IMAGE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Imagens informadas por URL http(s): tamanho máximo de cada imagem e
+# downloads simultâneos. Com o tamanho informado no HEAD, o download é
+# repassado em streaming ao corpo do envio, sem arquivo temporário
+IMAGE_URL_MAX_BYTES = int(os.getenv("ACERTPIX_IMAGE_URL_MAX_BYTES", str(20 * 1024 * 1024)))
+IMAGE_URL_MAX_CONCURRENT = max(int(os.getenv("ACERTPIX_IMAGE_URL_MAX_CONCURRENT", "4")), 1)
+
+# Validação local dos envios, antes de qualquer chamada à API: tamanho máximo
+# de cada imagem (com o pré-processamento, da imagem já reduzida); 0 desativa
+IMAGE_MAX_BYTES = int(os.getenv("ACERTPIX_IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+FORMATOS_IMAGEM = "JPEG, PNG, WebP, BMP, TIFF ou HEIC"
+
+# Cache das consultas (Consultar e ObterLaudo), limitado por entradas e bytes;
+# RESPONSE_CACHE_MAX_BYTES = 0 desativa. Resultados finalizados (status com uma
+# das palavras de RESPONSE_CACHE_FINAL_STATUS) e laudos valem por
+# RESPONSE_CACHE_TTL_FINAL segundos; os demais, em andamento, só por
+# RESPONSE_CACHE_TTL_PENDING, para que o acompanhamento veja as mudanças
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("ACERTPIX_RESPONSE_CACHE_MAX_ENTRIES", "512"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("ACERTPIX_RESPONSE_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+RESPONSE_CACHE_TTL_FINAL = float(os.getenv("ACERTPIX_RESPONSE_CACHE_TTL_FINAL", "3600"))
+RESPONSE_CACHE_TTL_PENDING = float(os.getenv("ACERTPIX_RESPONSE_CACHE_TTL_PENDING", "5"))
+# Chaves e ids não encontrados (404 ou mensagem de "não encontrado") são
+# recusados localmente por RESPONSE_CACHE_TTL_NOT_FOUND segundos, ou até um
+# envio bem-sucedido da mesma chave; 0 desativa
+RESPONSE_CACHE_TTL_NOT_FOUND = float(os.getenv("ACERTPIX_RESPONSE_CACHE_TTL_NOT_FOUND", "30"))
+RESPONSE_CACHE_FINAL_STATUS = {
+    palavra.strip().lower()
+    for palavra in os.getenv(
+        "ACERTPIX_RESPONSE_CACHE_FINAL_STATUS",
+        "finalizado,finalizada,concluido,concluida,aprovado,aprovada,reprovado,reprovada,"
+        "cancelado,cancelada,recusado,recusada,negado,negada,expirado,expirada",
+    ).split(",")
+    if palavra.strip()
+}
+# Palavras que, em qualquer posição, indicam resultado ainda em andamento, e
+# as que negam a palavra de estado final que vem depois delas ("não concluído")
+STATUS_EM_ANDAMENTO = {"aguardando", "pendente", "processando", "andamento", "analisando"}
+STATUS_NEGACOES = {"nao", "sem", "nunca", "ainda"}
+
+# Armazenamento local, em disco, dos laudos finalizados (imutáveis), para não
+# baixá-los de novo: diretório exclusivo deste servidor (vazio = desativado) e
+# tamanho máximo, descartando os usados há mais tempo
+REPORT_STORE_DIR = os.getenv("ACERTPIX_REPORT_STORE_DIR", "")
+REPORT_STORE_MAX_BYTES = int(os.getenv("ACERTPIX_REPORT_STORE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Campos de imagem das ferramentas de envio: caminho do arquivo, URL http(s)
+# ou a própria imagem (base64, URI data: ou recurso MCP embutido)
+ImagemEntrada = Union[str, Dict[str, Any]]
+SCHEMA_IMAGEM = {
+    "anyOf": [{"type": "string"}, {"type": "object"}],
+    "description": (
+        "Caminho do arquivo (ou URI file://), URL http(s), imagem em base64, URI data: "
+        "em base64 ou recurso MCP embutido com o conteúdo em base64 (blob)"
+    ),
+}
+
 server = Server("acertpix-api-facematch")
 
 @server.list_tools()
@@ -47,6 +248,7 @@ async def handle_list_tools() -> list[types.Tool]:
                 "type": "object",
                 "properties": {
                     "id": {"type": "integer"},
+                    "forcarAtualizacao": {"type": "boolean", "description": "Ignora o cache e consulta a API"},
                 },
                 "required": ["id"]
             },
@@ -59,9 +261,10 @@ async def handle_list_tools() -> list[types.Tool]:
                 "properties": {
                     "chave": {"type": "string"},
                     "cpf": {"type": "string"},
-                    "caminhoImagemFrente": {"type": "string"},
-                    "caminhoImagemVerso": {"type": "string"},
-                    "caminhoImagemSelfie": {"type": "string"},
+                    "caminhoImagemFrente": SCHEMA_IMAGEM,
+                    "caminhoImagemVerso": SCHEMA_IMAGEM,
+                    "caminhoImagemSelfie": SCHEMA_IMAGEM,
+                    "chaveIdempotencia": {"type": "string"},
                 },
                 "required": ["chave", "caminhoImagemFrente", "caminhoImagemSelfie"]
             },
@@ -74,82 +277,1408 @@ async def handle_list_tools() -> list[types.Tool]:
                 "properties": {
                     "id": {"type": "integer"},
                     "caminho_salvar": {"type": "string"},
+                    "forcarAtualizacao": {"type": "boolean", "description": "Ignora o cache e consulta a API"},
+                    "retornarConteudo": {
+                        "type": "boolean",
+                        "description": (
+                            "Devolve o PDF na resposta, como recurso embutido, em vez de "
+                            "gravá-lo em caminho_salvar (que passa a ser opcional)"
+                        ),
+                    },
                 },
-                "required": ["id", "caminho_salvar"]
+                "required": ["id"]
             },
+        ),
+        types.Tool(
+            name="diagnostico-facematch",
+            description="Mostra o estado interno do servidor (token, conexões, circuit breakers, limites de taxa e envios em andamento)",
+            inputSchema={
+                "type": "object",
+                "properties": {},
+            },
+        ),
+    ]
+
+# Cliente HTTP compartilhado por todas as ferramentas, mantendo conexões
+# (TCP/TLS) abertas com keep-alive entre as chamadas
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _criar_http_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    http2 = HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        print(
+            "AVISO:    ACERTPIX_HTTP2 ativo, mas o pacote 'h2' não está instalado; usando HTTP/1.1"
+        )
+        http2 = False
+    # Com http2=True o protocolo é negociado via ALPN: se o servidor não
+    # oferecer h2, a conexão segue normalmente em HTTP/1.1
+    return httpx.AsyncClient(verify=SSL_VERIFY, limits=limits, http2=http2)
+
+
+def obter_http_client() -> httpx.AsyncClient:
+    """
+    Retorna o cliente HTTP compartilhado do servidor.
+    Normalmente criado em main(); é criado sob demanda se ainda não existir.
+    """
+    global _http_client
+
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _criar_http_client()
+    return _http_client
+
+
+async def fechar_http_client() -> None:
+    """
+    Fecha o cliente HTTP compartilhado e suas conexões.
+    """
+    global _http_client
+
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+# Instante (time.monotonic) até o qual a ferramenta em execução pode rodar
+_prazo_ferramenta: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "prazo_ferramenta", default=None
+)
+
+
+def _com_prazo(ferramenta):
+    """
+    Limita a execução da ferramenta a TOOL_DEADLINE segundos, cobrindo a
+    obtenção do token e a requisição principal. O prazo é propagado às
+    chamadas HTTP, que recebem apenas o tempo que ainda resta.
+    """
+
+    @functools.wraps(ferramenta)
+    async def executar(*args: Any, **kwargs: Any) -> Any:
+        if TOOL_DEADLINE <= 0:
+            return await ferramenta(*args, **kwargs)
+
+        contexto = _prazo_ferramenta.set(time.monotonic() + TOOL_DEADLINE)
+        try:
+            return await asyncio.wait_for(ferramenta(*args, **kwargs), TOOL_DEADLINE)
+        except asyncio.TimeoutError as e:
+            raise TimeoutError(
+                f"Prazo de {TOOL_DEADLINE:g}s da ferramenta '{ferramenta.__name__}' excedido"
+            ) from e
+        finally:
+            _prazo_ferramenta.reset(contexto)
+
+    return executar
+
+
+def _timeout_para(familia: str) -> httpx.Timeout:
+    """
+    Retorna o timeout da família de endpoint, reduzido ao tempo que ainda
+    resta do prazo da ferramenta em execução.
+    """
+    fases = dict(HTTP_TIMEOUTS[familia])
+    prazo = _prazo_ferramenta.get()
+    if prazo is not None:
+        restante = prazo - time.monotonic()
+        if restante <= 0:
+            raise TimeoutError(f"Prazo de {TOOL_DEADLINE:g}s da ferramenta esgotado")
+        fases = {fase: min(segundos, restante) for fase, segundos in fases.items()}
+    return httpx.Timeout(**fases)
+
+
+class CircuitoAbertoError(Exception):
+    """
+    Chamada recusada localmente porque o circuito do endpoint está aberto.
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de uma família de endpoints da API.
+
+    closed: as chamadas passam; após BREAKER_FAILURE_THRESHOLD falhas
+    seguidas (erro de rede ou 5xx) o circuito abre.
+    open: as chamadas falham imediatamente por BREAKER_RESET_TIMEOUT segundos.
+    half-open: até BREAKER_HALF_OPEN_MAX_CALLS chamadas de teste passam; um
+    sucesso fecha o circuito e uma falha o abre novamente.
+    """
+
+    def __init__(self, nome: str):
+        self.nome = nome
+        self.estado = "closed"
+        self.falhas = 0
+        self.aberto_em = 0.0
+        self.testes_em_andamento = 0
+
+    def permitir(self) -> None:
+        if self.estado == "open":
+            restante = BREAKER_RESET_TIMEOUT - (time.monotonic() - self.aberto_em)
+            if restante > 0:
+                raise CircuitoAbertoError(
+                    f"Circuito de {self.nome} aberto após {self.falhas} falhas seguidas; "
+                    f"API indisponível, nova tentativa liberada em {restante:.0f}s"
+                )
+            self.estado = "half-open"
+            self.testes_em_andamento = 0
+
+        if self.estado == "half-open":
+            if self.testes_em_andamento >= BREAKER_HALF_OPEN_MAX_CALLS:
+                raise CircuitoAbertoError(
+                    f"Circuito de {self.nome} em teste (half-open); aguarde o resultado"
+                )
+            self.testes_em_andamento += 1
+
+    def registrar_sucesso(self) -> None:
+        if self.estado != "closed":
+            print(f"INFO:     Circuito de {self.nome} fechado")
+        self.estado = "closed"
+        self.falhas = 0
+        self.testes_em_andamento = 0
+
+    def registrar_falha(self) -> None:
+        self.falhas += 1
+        if self.estado == "half-open" or self.falhas >= BREAKER_FAILURE_THRESHOLD:
+            if self.estado != "open":
+                print(f"AVISO:    Circuito de {self.nome} aberto após {self.falhas} falhas")
+            self.estado = "open"
+            self.aberto_em = time.monotonic()
+            self.testes_em_andamento = 0
+
+    def liberar(self) -> None:
+        # Chamada interrompida sem resultado (ex.: cancelada): não conta como teste
+        if self.estado == "half-open" and self.testes_em_andamento > 0:
+            self.testes_em_andamento -= 1
+
+    def diagnostico(self) -> Dict[str, Any]:
+        info: Dict[str, Any] = {"estado": self.estado, "falhas_seguidas": self.falhas}
+        if self.estado == "open":
+            restante = BREAKER_RESET_TIMEOUT - (time.monotonic() - self.aberto_em)
+            info["reabre_em_s"] = round(max(restante, 0.0), 1)
+        return info
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def _circuit_breaker_para(url: str) -> CircuitBreaker:
+    caminho = httpx.URL(url).path
+    if caminho.startswith(TOKEN_ENDPOINT):
+        nome = TOKEN_ENDPOINT
+    else:
+        nome = "/" + caminho.strip("/").split("/")[0]
+    if nome not in _circuit_breakers:
+        _circuit_breakers[nome] = CircuitBreaker(nome)
+    return _circuit_breakers[nome]
+
+
+async def _com_circuit_breaker(
+    url: str, enviar: Callable[[], Awaitable[httpx.Response]]
+) -> httpx.Response:
+    """
+    Executa a requisição através do circuit breaker da família do endpoint.
+    Com o circuito aberto, falha na hora com CircuitoAbertoError.
+    """
+    circuit_breaker = _circuit_breaker_para(url)
+    circuit_breaker.permitir()
+    try:
+        response = await enviar()
+    except httpx.TransportError:
+        circuit_breaker.registrar_falha()
+        raise
+    except BaseException:
+        circuit_breaker.liberar()
+        raise
+
+    if response.status_code >= 500:
+        circuit_breaker.registrar_falha()
+    else:
+        circuit_breaker.registrar_sucesso()
+    return response
+
+
+class LimiteTaxaExcedidoError(Exception):
+    """
+    Chamada recusada localmente porque a fila do limite de taxa está longa demais.
+    """
+
+
+class TokenBucket:
+    """
+    Limite de taxa por token bucket: até `capacidade` chamadas em rajada e,
+    depois, `taxa` chamadas por segundo. Quem excede o orçamento aguarda na
+    fila (em ordem de chegada) em vez de receber 429 da API.
+    """
+
+    def __init__(self, nome: str, taxa: float, capacidade: float):
+        self.nome = nome
+        self.taxa = taxa
+        self.capacidade = max(capacidade, 1.0)
+        self.tokens = self.capacidade
+        self.atualizado_em = time.monotonic()
+        self.aguardando = 0
+        self._fila = asyncio.Lock()
+
+    def _repor(self) -> None:
+        agora = time.monotonic()
+        decorrido = agora - self.atualizado_em
+        self.tokens = min(self.capacidade, self.tokens + decorrido * self.taxa)
+        self.atualizado_em = agora
+
+    async def adquirir(self) -> None:
+        if self.taxa <= 0:
+            return
+
+        self._repor()
+        espera_estimada = (self.aguardando + 1 - self.tokens) / self.taxa
+        limite = RATE_LIMIT_MAX_WAIT
+        prazo = _prazo_ferramenta.get()
+        if prazo is not None:
+            limite = min(limite, prazo - time.monotonic())
+        if espera_estimada > limite:
+            raise LimiteTaxaExcedidoError(
+                f"Limite de {self.taxa:g} chamadas/s de {self.nome} atingido; "
+                f"espera estimada de {espera_estimada:.1f}s excede {limite:.1f}s"
+            )
+
+        self.aguardando += 1
+        try:
+            # asyncio.Lock atende em ordem de chegada (FIFO)
+            async with self._fila:
+                self._repor()
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.taxa)
+                    self._repor()
+                self.tokens -= 1
+        finally:
+            self.aguardando -= 1
+
+    def diagnostico(self) -> Dict[str, Any]:
+        if self.taxa <= 0:
+            return {"limite_por_s": None}
+        self._repor()
+        return {
+            "limite_por_s": self.taxa,
+            "rajada": self.capacidade,
+            "tokens_disponiveis": round(self.tokens, 2),
+            "aguardando": self.aguardando,
+        }
+
+
+_rate_limiters = {
+    "enviar": TokenBucket("envios", RATE_LIMIT_ENVIAR, RATE_BURST_ENVIAR),
+    "consulta": TokenBucket("consultas", RATE_LIMIT_CONSULTA, RATE_BURST_CONSULTA),
+}
+
+
+def _rate_limiter_para(familia: str) -> TokenBucket:
+    # Consultar, ObterLaudo e ObterPdf compartilham o orçamento de leitura
+    return _rate_limiters["enviar" if familia == "enviar" else "consulta"]
+
+
+class ControleAdmissao:
+    """
+    Limita os envios em andamento por quantidade e pelos bytes de imagens
+    em envio. Envios que não cabem no orçamento aguardam em fila FIFO; um
+    envio maior que todo o orçamento só é admitido quando está sozinho.
+    """
+
+    def __init__(self, max_envios: int, max_bytes: int):
+        self.max_envios = max_envios
+        self.max_bytes = max_bytes
+        self.em_andamento = 0
+        self.bytes_em_uso = 0
+        self._fila: Deque[Tuple[int, "asyncio.Future[None]"]] = collections.deque()
+
+    def _cabe(self, tamanho: int) -> bool:
+        if self.em_andamento >= self.max_envios:
+            return False
+        return self.em_andamento == 0 or self.bytes_em_uso + tamanho <= self.max_bytes
+
+    def _ocupar(self, tamanho: int) -> None:
+        self.em_andamento += 1
+        self.bytes_em_uso += tamanho
+
+    def _liberar(self, tamanho: int) -> None:
+        self.em_andamento -= 1
+        self.bytes_em_uso -= tamanho
+        self._despachar()
+
+    def _despachar(self) -> None:
+        while self._fila and self._cabe(self._fila[0][0]):
+            tamanho, futuro = self._fila.popleft()
+            if futuro.done():
+                continue
+            self._ocupar(tamanho)
+            futuro.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def reservar(self, tamanho: int) -> AsyncIterator[None]:
+        if self._fila or not self._cabe(tamanho):
+            print(
+                f"INFO:     Envio aguardando na fila ({self.em_andamento} em andamento, "
+                f"{self.bytes_em_uso} bytes em uso)"
+            )
+            item = (tamanho, asyncio.get_running_loop().create_future())
+            self._fila.append(item)
+            try:
+                await item[1]
+            except BaseException:
+                if item[1].done() and not item[1].cancelled():
+                    # A vaga foi concedida junto com o cancelamento: devolve
+                    self._liberar(tamanho)
+                else:
+                    if item in self._fila:
+                        self._fila.remove(item)
+                    self._despachar()
+                raise
+        else:
+            self._ocupar(tamanho)
+
+        try:
+            yield
+        finally:
+            self._liberar(tamanho)
+
+    def diagnostico(self) -> Dict[str, Any]:
+        return {
+            "em_andamento": self.em_andamento,
+            "max_envios": self.max_envios,
+            "bytes_em_uso": self.bytes_em_uso,
+            "max_bytes": self.max_bytes,
+            "na_fila": len(self._fila),
+        }
+
+
+_admissao_envios = ControleAdmissao(UPLOAD_MAX_CONCURRENT, UPLOAD_MAX_BYTES)
+
+
+class CacheLRU:
+    """
+    Cache LRU limitado pelo total de bytes dos valores e, opcionalmente, pela
+    quantidade de entradas. Valores maiores que `max_bytes_entrada` não são
+    guardados; os guardados com `ttl` expiram após esse tempo, em segundos.
+    """
+
+    def __init__(self, max_bytes: int, max_bytes_entrada: int, max_entradas: int = 0):
+        self.max_bytes = max_bytes
+        self.max_bytes_entrada = max_bytes_entrada
+        self.max_entradas = max_entradas
+        self.bytes_em_uso = 0
+        self.acertos = 0
+        self.falhas = 0
+        # Valor e instante de expiração (time.monotonic) de cada entrada
+        self._entradas: "collections.OrderedDict[Any, Tuple[bytes, float]]" = collections.OrderedDict()
+
+    def obter(self, chave: Any) -> Optional[bytes]:
+        entrada = self._entradas.get(chave)
+        if entrada is not None and entrada[1] <= time.monotonic():
+            self.remover(chave)
+            entrada = None
+        if entrada is None:
+            self.falhas += 1
+            return None
+        self._entradas.move_to_end(chave)
+        self.acertos += 1
+        return entrada[0]
+
+    def guardar(self, chave: Any, valor: bytes, ttl: Optional[float] = None) -> None:
+        self.remover(chave)
+        if len(valor) > self.max_bytes_entrada or (ttl is not None and ttl <= 0):
+            return
+        expira_em = math.inf if ttl is None else time.monotonic() + ttl
+        self._entradas[chave] = (valor, expira_em)
+        self.bytes_em_uso += len(valor)
+        while self.bytes_em_uso > self.max_bytes or (
+            self.max_entradas and len(self._entradas) > self.max_entradas
+        ):
+            _, (removido, _) = self._entradas.popitem(last=False)
+            self.bytes_em_uso -= len(removido)
+
+    def remover(self, chave: Any) -> None:
+        entrada = self._entradas.pop(chave, None)
+        if entrada is not None:
+            self.bytes_em_uso -= len(entrada[0])
+
+    def diagnostico(self) -> Dict[str, Any]:
+        return {
+            "entradas": len(self._entradas),
+            "max_entradas": self.max_entradas or None,
+            "bytes_em_uso": self.bytes_em_uso,
+            "max_bytes": self.max_bytes,
+            "acertos": self.acertos,
+            "falhas": self.falhas,
+        }
+
+
+_cache_imagens = CacheLRU(IMAGE_CACHE_MAX_BYTES, IMAGE_CACHE_MAX_BYTES // 4)
+_cache_consultas = CacheLRU(
+    RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MAX_ENTRIES
+)
+# Cache negativo: motivo da recusa (status HTTP) por família e chave ou id
+_cache_nao_encontrados = CacheLRU(RESPONSE_CACHE_MAX_BYTES, 1024, RESPONSE_CACHE_MAX_ENTRIES)
+
+# ioctl do Linux que clona um arquivo por reflink (cópia sob demanda)
+FICLONE = 0x40049409
+
+
+def _sha256_arquivo(caminho: str) -> str:
+    resumo = hashlib.sha256()
+    with open(caminho, "rb") as arquivo:
+        while trecho := arquivo.read(1024 * 1024):
+            resumo.update(trecho)
+    return resumo.hexdigest()
+
+
+def _clonar_arquivo(origem: str, destino: str) -> str:
+    """
+    Cria `destino` (um nome novo) com o conteúdo de `origem`: por reflink ou
+    hard link quando estão no mesmo sistema de arquivos, senão por cópia.
+    Devolve o modo usado.
+    """
+    try:
+        import fcntl
+
+        with open(origem, "rb") as o, open(destino, "xb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, o.fileno())
+        return "reflink"
+    except (ImportError, OSError):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(destino)
+    try:
+        os.link(origem, destino)
+        return "hard link"
+    except OSError:
+        shutil.copyfile(origem, destino)
+        return "cópia"
+
+
+def _chave_deposito(chave: Tuple[str, Any]) -> str:
+    # Separa os laudos por API e cliente: ids iguais em contas diferentes não se misturam
+    conta = hashlib.sha256(f"{API_BASE_URL}|{CLIENT_ID}".encode("utf-8")).hexdigest()[:16]
+    return f"{conta}/{chave[0]}/{chave[1]}"
+
+
+class DepositoLaudos:
+    """
+    Armazenamento local dos laudos finalizados, endereçado pelo conteúdo:
+    cada laudo fica em objetos/<sha256> e o índice (indice.json, mantido em
+    memória) liga a família do endpoint e o id ao sha256, com busca O(1).
+    Laudos iguais ocupam um só objeto. Acima de `max_bytes`, os usados há
+    mais tempo são descartados. O tamanho e a data de modificação de cada
+    objeto são conferidos a cada leitura; um objeto alterado é descartado.
+    A ordem de uso das leituras vai para o disco junto com a próxima gravação.
+    Falhas de disco só geram log: a ferramenta segue consultando a API.
+    """
+
+    def __init__(self, diretorio: str, max_bytes: int):
+        self.diretorio = diretorio
+        self.max_bytes = max_bytes
+        self.bytes_em_uso = 0
+        self.acertos = 0
+        self.falhas = 0
+        # Entradas do índice, da usada há mais tempo à mais recente
+        self._entradas: "collections.OrderedDict[str, Dict[str, Any]]" = collections.OrderedDict()
+        # Quantas entradas apontam para cada objeto
+        self._referencias: Dict[str, int] = {}
+        self._carregado = False
+        self._lock = asyncio.Lock()
+
+    @property
+    def ativo(self) -> bool:
+        return bool(self.diretorio) and self.max_bytes > 0
+
+    def _objeto(self, sha256: str) -> str:
+        return os.path.join(self.diretorio, "objetos", sha256)
+
+    def _carregar(self) -> None:
+        """
+        Lê o índice do disco e apaga os objetos que ele não referencia
+        (sobras de uma gravação interrompida ou de descartes).
+        """
+        os.makedirs(os.path.join(self.diretorio, "objetos"), mode=0o700, exist_ok=True)
+        try:
+            with open(os.path.join(self.diretorio, "indice.json"), "r", encoding="utf-8") as arquivo:
+                dados = json.load(arquivo)
+        except FileNotFoundError:
+            dados = {}
+        except (OSError, ValueError) as e:
+            print(f"ERRO:     Índice do armazenamento de laudos ignorado: {e}")
+            dados = {}
+        for chave, entrada in (dados.get("entradas") or {}).items() if isinstance(dados, dict) else ():
+            if isinstance(entrada, dict) and all(
+                isinstance(entrada.get(campo), t)
+                for campo, t in (("sha256", str), ("bytes", int), ("mtime_ns", int))
+            ):
+                self._adicionar(chave, entrada)
+        for nome in os.listdir(os.path.join(self.diretorio, "objetos")):
+            if nome not in self._referencias:
+                with contextlib.suppress(OSError):
+                    os.unlink(self._objeto(nome))
+
+    def _salvar(self, dados: str) -> None:
+        fd, temporario = tempfile.mkstemp(dir=self.diretorio, prefix=".indice-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as arquivo:
+                arquivo.write(dados)
+            os.replace(temporario, os.path.join(self.diretorio, "indice.json"))
+        except BaseException:
+            os.unlink(temporario)
+            raise
+
+    def _adicionar(self, chave: str, entrada: Dict[str, Any]) -> List[str]:
+        """
+        Registra a entrada no índice em memória e descarta as usadas há mais
+        tempo acima do limite. Devolve os objetos que ficaram sem referência.
+        """
+        orfaos = self._retirar(chave)
+        self._entradas[chave] = entrada
+        if self._referencias.get(entrada["sha256"], 0) == 0:
+            self.bytes_em_uso += entrada["bytes"]
+        self._referencias[entrada["sha256"]] = self._referencias.get(entrada["sha256"], 0) + 1
+        while self.bytes_em_uso > self.max_bytes and len(self._entradas) > 1:
+            orfaos += self._retirar(next(iter(self._entradas)))
+        return [sha256 for sha256 in orfaos if sha256 not in self._referencias]
+
+    def _retirar(self, chave: str) -> List[str]:
+        entrada = self._entradas.pop(chave, None)
+        if entrada is None:
+            return []
+        sha256 = entrada["sha256"]
+        self._referencias[sha256] -= 1
+        if self._referencias[sha256]:
+            return []
+        del self._referencias[sha256]
+        self.bytes_em_uso -= entrada["bytes"]
+        return [sha256]
+
+    async def _persistir(self, orfaos: List[str]) -> None:
+        dados = json.dumps({"entradas": self._entradas})
+        await asyncio.to_thread(self._salvar, dados)
+        for sha256 in orfaos:
+            with contextlib.suppress(FileNotFoundError):
+                await asyncio.to_thread(os.unlink, self._objeto(sha256))
+
+    async def _preparar(self) -> bool:
+        if not self.ativo:
+            return False
+        if not self._carregado:
+            async with self._lock:
+                if not self._carregado:
+                    await asyncio.to_thread(self._carregar)
+                    self._carregado = True
+        return True
+
+    async def _localizar(self, chave: Tuple[str, Any]) -> Optional[str]:
+        """
+        Caminho do objeto do laudo, conferido no disco, ou None.
+        """
+        if not await self._preparar():
+            return None
+        chave_indice = _chave_deposito(chave)
+        entrada = self._entradas.get(chave_indice)
+        if entrada is not None:
+            objeto = self._objeto(entrada["sha256"])
+            try:
+                info = await asyncio.to_thread(os.stat, objeto)
+                if (info.st_size, info.st_mtime_ns) == (entrada["bytes"], entrada["mtime_ns"]):
+                    self._entradas.move_to_end(chave_indice)
+                    self.acertos += 1
+                    return objeto
+            except OSError:
+                pass
+            print(f"AVISO:    Laudo {chave[0]} {chave[1]} alterado no armazenamento local; descartado")
+            async with self._lock:
+                await self._persistir(self._retirar(chave_indice))
+        self.falhas += 1
+        return None
+
+    async def tamanho(self, chave: Tuple[str, Any]) -> Optional[int]:
+        """
+        Tamanho do laudo armazenado segundo o índice, sem ler nem conferir o
+        objeto no disco, ou None se ele não estiver armazenado.
+        """
+        if not await self._preparar():
+            return None
+        entrada = self._entradas.get(_chave_deposito(chave))
+        return None if entrada is None else entrada["bytes"]
+
+    async def ler(self, chave: Tuple[str, Any]) -> Optional[bytes]:
+        try:
+            objeto = await self._localizar(chave)
+            return None if objeto is None else await asyncio.to_thread(_ler_arquivo, objeto)
+        except OSError as e:
+            print(f"ERRO:     Erro ao ler o armazenamento de laudos: {e}")
+            return None
+
+    async def copiar_para(self, chave: Tuple[str, Any], destino: str) -> Optional[str]:
+        """
+        Cria `destino` a partir do laudo armazenado, por reflink ou hard link
+        quando possível, sem reescrever o conteúdo. Devolve o modo usado ou
+        None se o laudo não estiver armazenado.
+        """
+        try:
+            objeto = await self._localizar(chave)
+            if objeto is None:
+                return None
+            return await asyncio.to_thread(_substituir_por_clone, objeto, destino)
+        except OSError as e:
+            print(f"ERRO:     Erro ao copiar do armazenamento de laudos: {e}")
+            return None
+
+    async def guardar_bytes(self, chave: Tuple[str, Any], conteudo: bytes) -> None:
+        try:
+            if await self._preparar():
+                sha256 = hashlib.sha256(conteudo).hexdigest()
+                await self._guardar(chave, sha256, functools.partial(_gravar_objeto, conteudo))
+        except OSError as e:
+            print(f"ERRO:     Erro ao gravar no armazenamento de laudos: {e}")
+
+    async def guardar_arquivo(self, chave: Tuple[str, Any], caminho: str) -> None:
+        try:
+            if await self._preparar():
+                sha256 = await asyncio.to_thread(_sha256_arquivo, caminho)
+                await self._guardar(chave, sha256, functools.partial(_clonar_arquivo, caminho))
+        except OSError as e:
+            print(f"ERRO:     Erro ao gravar no armazenamento de laudos: {e}")
+
+    async def _guardar(
+        self, chave: Tuple[str, Any], sha256: str, criar: Callable[[str], Any]
+    ) -> None:
+        objeto = self._objeto(sha256)
+        info = await asyncio.to_thread(_publicar_objeto, objeto, criar)
+        if info.st_size > self.max_bytes:
+            if sha256 not in self._referencias:
+                await asyncio.to_thread(os.unlink, objeto)
+            return
+        async with self._lock:
+            orfaos = self._adicionar(
+                _chave_deposito(chave),
+                {"sha256": sha256, "bytes": info.st_size, "mtime_ns": info.st_mtime_ns},
+            )
+            await self._persistir(orfaos)
+
+    def remover(self, chave: Tuple[str, Any]) -> None:
+        # Só no índice em memória; o disco é atualizado na próxima gravação
+        # e o objeto órfão, apagado no próximo carregamento
+        if self._carregado:
+            self._retirar(_chave_deposito(chave))
+
+    def diagnostico(self) -> Dict[str, Any]:
+        return {
+            "diretorio": self.diretorio or None,
+            "entradas": len(self._entradas),
+            "objetos": len(self._referencias),
+            "bytes_em_uso": self.bytes_em_uso,
+            "max_bytes": self.max_bytes,
+            "acertos": self.acertos,
+            "falhas": self.falhas,
+        }
+
+
+def _ler_arquivo(caminho: str) -> bytes:
+    with open(caminho, "rb") as arquivo:
+        return arquivo.read()
+
+
+def _gravar_objeto(conteudo: bytes, caminho: str) -> None:
+    with open(caminho, "xb") as arquivo:
+        arquivo.write(conteudo)
+
+
+def _publicar_objeto(objeto: str, criar: Callable[[str], Any]) -> os.stat_result:
+    """
+    Cria o objeto (se ainda não existe) por um nome temporário renomeado
+    atomicamente, para que nunca fique um objeto pela metade.
+    """
+    if not os.path.exists(objeto):
+        temporario = f"{objeto}.{os.urandom(4).hex()}.parcial"
+        try:
+            criar(temporario)
+            os.replace(temporario, objeto)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(temporario)
+            raise
+    return os.stat(objeto)
+
+
+def _substituir_por_clone(origem: str, destino: str) -> str:
+    # Destino que já é um hard link para o objeto (cópia anterior) fica como está
+    with contextlib.suppress(FileNotFoundError):
+        if os.path.samestat(os.stat(origem), os.stat(destino)):
+            return "hard link"
+    diretorio, nome = os.path.split(os.path.abspath(destino))
+    temporario = os.path.join(diretorio, f".{nome}.{os.urandom(4).hex()}.parcial")
+    try:
+        modo = _clonar_arquivo(origem, temporario)
+        os.replace(temporario, destino)
+    finally:
+        # os.replace entre dois nomes do mesmo inode não remove a origem
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temporario)
+    return modo
+
+
+_deposito_laudos = DepositoLaudos(REPORT_STORE_DIR, REPORT_STORE_MAX_BYTES)
+
+
+def _sem_acentos(texto: str) -> str:
+    return unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode().lower()
+
+
+def _status_finalizado(valor: str) -> bool:
+    """
+    Indica se um texto de status ou situação descreve um estado final: tem
+    uma palavra inteira de RESPONSE_CACHE_FINAL_STATUS ("Finalizado com
+    sucesso") sem negação antes dela ("Não concluído"), não começa com "em"
+    ("Em finalização") e não tem palavra de STATUS_EM_ANDAMENTO ("Aguardando
+    conclusão").
+    """
+    palavras = re.findall(r"[a-z]+", _sem_acentos(valor))
+    if not palavras or palavras[0] == "em" or STATUS_EM_ANDAMENTO.intersection(palavras):
+        return False
+    for palavra in palavras:
+        if palavra in STATUS_NEGACOES:
+            return False
+        if palavra in RESPONSE_CACHE_FINAL_STATUS:
+            return True
+    return False
+
+
+def _estado_resultado(dados: Any, profundidade: int = 3) -> Optional[bool]:
+    """
+    Estado do resultado de uma consulta: True se finalizado, False se em
+    andamento e None se não há campo de status ou situação. Em cada objeto,
+    os campos de status ou situação do próprio nível decidem sozinhos (todos
+    finalizados, ver _status_finalizado); só sem eles os objetos aninhados
+    são consultados, e qualquer um em andamento deixa o resultado em andamento.
+    """
+    if not profundidade:
+        return None
+    if isinstance(dados, list):
+        estados = [_estado_resultado(item, profundidade) for item in dados]
+        if False in estados:
+            return False
+        return True if estados and all(estados) else None
+    if not isinstance(dados, dict):
+        return None
+    status = [
+        valor
+        for campo, valor in dados.items()
+        if isinstance(valor, str) and _sem_acentos(str(campo)).startswith(("status", "situacao"))
+    ]
+    if status:
+        return all(_status_finalizado(valor) for valor in status)
+    estados = [
+        _estado_resultado(valor, profundidade - 1)
+        for valor in dados.values()
+        if isinstance(valor, (dict, list))
+    ]
+    if False in estados:
+        return False
+    return True if True in estados else None
+
+
+def _resultado_finalizado(dados: Any) -> bool:
+    """
+    Indica se o resultado de uma consulta está em estado final (ver
+    _estado_resultado). Na dúvida, não está.
+    """
+    return _estado_resultado(dados) is True
+
+
+class NaoEncontradoError(Exception):
+    """
+    Consulta recusada localmente: a API respondeu há pouco que a chave ou id
+    não existe (ver RESPONSE_CACHE_TTL_NOT_FOUND).
+    """
+
+
+def _indica_nao_encontrado(response: httpx.Response) -> bool:
+    """
+    Resposta de chave ou id inexistente: HTTP 404, ou corpo JSON curto com
+    mensagem de "não encontrado" (em qualquer status 2xx ou 4xx).
+    """
+    if response.status_code == 404:
+        return True
+    if response.status_code >= 500 or len(response.content) > 4096:
+        return False
+    try:
+        dados = response.json()
+    except ValueError:
+        return False
+    textos = dados.values() if isinstance(dados, dict) else [dados]
+    return any(
+        isinstance(texto, str)
+        and any(trecho in _sem_acentos(texto) for trecho in ("nao encontrad", "not found", "inexistente"))
+        for texto in textos
+    )
+
+
+def _recusar_nao_encontrado(chave: Tuple[str, Any]) -> None:
+    motivo = _cache_nao_encontrados.obter(chave)
+    if motivo is not None:
+        raise NaoEncontradoError(
+            f"{chave[1]} não encontrado na API ({motivo.decode()}, resposta recente em cache); "
+            "use forcarAtualizacao para consultar novamente"
+        )
+
+
+def _consulta_em_cache(chave: Tuple[str, Any]) -> Optional[Any]:
+    """
+    Resultado de uma consulta (família do endpoint, chave ou id) ainda válido
+    no cache, ou None. Falha na hora com NaoEncontradoError se a API acabou
+    de responder que a chave ou id não existe.
+    """
+    _recusar_nao_encontrado(chave)
+    conteudo = _cache_consultas.obter(chave)
+    return None if conteudo is None else json.loads(conteudo)
+
+
+# Consultas em andamento por família e chave ou id (ver _requisicao_compartilhada)
+_requisicoes_em_andamento: Dict[Tuple[str, Any], "asyncio.Future[Any]"] = {}
+
+# Geração de cada família e chave ou id com consulta à API em curso,
+# incrementada por _invalidar_consultas, e quantas consultas estão em curso;
+# a entrada só existe enquanto houver consulta em curso
+_geracoes_consultas: Dict[Tuple[str, Any], List[int]] = {}
+# Chave e geração da consulta em curso na tarefa atual (ver _consulta_em_curso)
+_consulta_atual: contextvars.ContextVar[Optional[Tuple[Tuple[str, Any], int]]] = (
+    contextvars.ContextVar("consulta_atual", default=None)
+)
+
+
+@contextlib.contextmanager
+def _consulta_em_curso(chave: Tuple[str, Any]) -> Iterator[None]:
+    """
+    Registra a geração da chave no início de uma consulta à API. Se um envio
+    bem-sucedido invalidar a chave antes de a resposta chegar, a resposta,
+    que pode ser anterior ao envio, não vai para os caches (ver
+    _consulta_invalidada).
+    """
+    entrada = _geracoes_consultas.setdefault(chave, [0, 0])
+    entrada[1] += 1
+    contexto = _consulta_atual.set((chave, entrada[0]))
+    try:
+        yield
+    finally:
+        _consulta_atual.reset(contexto)
+        entrada[1] -= 1
+        if not entrada[1]:
+            del _geracoes_consultas[chave]
+
+
+def _consulta_invalidada(chave: Tuple[str, Any]) -> bool:
+    atual = _consulta_atual.get()
+    if atual is None or atual[0] != chave:
+        return False
+    entrada = _geracoes_consultas.get(chave)
+    return entrada is not None and entrada[0] != atual[1]
+
+
+async def _executar_consulta(chave: Tuple[str, Any], requisitar: Callable[[], Awaitable[Any]]) -> Any:
+    with _consulta_em_curso(chave):
+        return await requisitar()
+
+
+async def _requisicao_compartilhada(
+    chave: Tuple[str, Any], requisitar: Callable[[], Awaitable[Any]]
+) -> Any:
+    """
+    Single-flight: chamadas simultâneas com a mesma chave aguardam a mesma
+    requisição e recebem o mesmo resultado já interpretado (ou a mesma
+    exceção). Quem desiste de esperar (cancelamento ou prazo da ferramenta)
+    não cancela a requisição dos demais.
+    """
+    tarefa = _requisicoes_em_andamento.get(chave)
+    if tarefa is None:
+        tarefa = asyncio.ensure_future(_executar_consulta(chave, requisitar))
+        _requisicoes_em_andamento[chave] = tarefa
+        tarefa.add_done_callback(functools.partial(_finalizar_requisicao, chave))
+    return await asyncio.shield(tarefa)
+
+
+def _finalizar_requisicao(chave: Tuple[str, Any], tarefa: "asyncio.Future[Any]") -> None:
+    if _requisicoes_em_andamento.get(chave) is tarefa:
+        del _requisicoes_em_andamento[chave]
+    # Sem ninguém esperando, a exceção não seria lida (e geraria aviso no log)
+    if not tarefa.cancelled():
+        tarefa.exception()
+
+
+def _registrar_nao_encontrado(chave: Tuple[str, Any], response: httpx.Response) -> None:
+    """
+    Guarda no cache negativo as respostas de erro de chave ou id inexistente.
+    """
+    if _consulta_invalidada(chave):
+        return
+    if response.is_error and _indica_nao_encontrado(response):
+        motivo = f"HTTP {response.status_code} {response.reason_phrase}".strip()
+        _cache_nao_encontrados.guardar(chave, motivo.encode(), RESPONSE_CACHE_TTL_NOT_FOUND)
+
+
+def _guardar_consulta(chave: Tuple[str, Any], response: httpx.Response, finalizado: bool) -> None:
+    if _consulta_invalidada(chave):
+        return
+    _cache_nao_encontrados.remover(chave)
+    if _indica_nao_encontrado(response):
+        ttl = RESPONSE_CACHE_TTL_NOT_FOUND
+    elif finalizado:
+        ttl = RESPONSE_CACHE_TTL_FINAL
+    else:
+        ttl = RESPONSE_CACHE_TTL_PENDING
+    _cache_consultas.guardar(chave, response.content, ttl)
+
+
+def _invalidar_consultas(chave: Any, resultado: Any) -> None:
+    """
+    Após um envio bem-sucedido, descarta o que estava em cache (consulta e
+    "não encontrado") para a chave enviada e para o id devolvido pela API.
+    """
+    chaves = [("consultar", chave)]
+    if isinstance(resultado, dict):
+        for campo, valor in resultado.items():
+            if str(campo).lower() == "id" and isinstance(valor, (int, str)):
+                chaves += [(familia, valor) for familia in ("consultar", "obter_laudo", "obter_pdf")]
+    for chave_cache in chaves:
+        _cache_consultas.remover(chave_cache)
+        _cache_nao_encontrados.remover(chave_cache)
+        _deposito_laudos.remover(chave_cache)
+        # Consulta iniciada antes do envio: as próximas não a aproveitam e a
+        # resposta dela não entra nos caches
+        _requisicoes_em_andamento.pop(chave_cache, None)
+        if chave_cache in _geracoes_consultas:
+            _geracoes_consultas[chave_cache][0] += 1
+
+
+def diagnostico_servidor() -> Dict[str, Any]:
+    """
+    Estado interno do servidor: token, cliente HTTP, circuit breakers,
+    limites de taxa, envios em andamento e caches de imagens e de consultas.
+    """
+    expira_em = _token_cache["expira_em"] - time.time()
+    return {
+        "api": API_BASE_URL,
+        "token": {
+            "em_cache": bool(_token_cache["access_token"]) and expira_em > 0,
+            "renova_em_s": round(max(expira_em, 0.0), 1),
+        },
+        "http": {
+            "http2": HTTP2,
+            "max_conexoes": HTTP_MAX_CONNECTIONS,
+            "max_conexoes_keepalive": HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        },
+        "circuit_breakers": {
+            nome: circuit_breaker.diagnostico()
+            for nome, circuit_breaker in sorted(_circuit_breakers.items())
+        },
+        "limites_de_taxa": {
+            nome: rate_limiter.diagnostico()
+            for nome, rate_limiter in _rate_limiters.items()
+        },
+        "envios": _admissao_envios.diagnostico(),
+        "cache_imagens": _cache_imagens.diagnostico(),
+        "cache_consultas": _cache_consultas.diagnostico(),
+        "cache_nao_encontrados": _cache_nao_encontrados.diagnostico(),
+        "armazenamento_laudos": _deposito_laudos.diagnostico(),
+        "consultas_em_andamento": len(_requisicoes_em_andamento),
+    }
+
+
+async def _internal_get_access_token(client_id: str, client_secret: str) -> Dict[str, Any]:
+    """
+    Lógica interna para obter um novo token de acesso da API.
+    Retorna a resposta completa da API de Token (access_token, expires_in...).
+    Levanta exceção em caso de erro.
+    """
+    url = f"{API_BASE_URL}{TOKEN_ENDPOINT}"
+    payload = {
+        "Scope": "api",
+        "GrantType": "client_credentials",
+        "ClientId": client_id,
+        "ClientSecret": client_secret
+    }
+    headers = {"Content-Type": "application/json", "Accept": "application/json"}
+
+    print(f"INFO:     Tentando obter token de: {url}")
+
+    client = obter_http_client()
+    try:
+        # Obter o token (client_credentials) é idempotente: pode ser repetido
+        response = await _com_retentativas(
+            f"POST {url}",
+            True,
+            lambda: _com_circuit_breaker(
+                url,
+                lambda: client.post(
+                    url, json=payload, headers=headers, timeout=_timeout_para("token")
+                ),
+            ),
+        )
+        print(f"INFO:     Resposta Token Status: {response.status_code}")
+        print(f"INFO:     Protocolo HTTP negociado: {response.http_version}")
+
+        response.raise_for_status()
+
+        token_data = response.json()
+        if "access_token" not in token_data:
+            raise ValueError(f"Campo 'access_token' não encontrado na resposta da API de Token: {token_data}")
+
+        token = token_data["access_token"]
+        print(f"INFO:     Token obtido com sucesso (prefixo): {token[:10]}...")
+        return token_data
+    except httpx.RequestError as e:
+        print(f"ERRO:     Erro de rede ao obter token: {e}")
+        raise Exception(f"Erro de rede ao conectar com {e.request.url!r}: {e}") from e
+    except httpx.HTTPStatusError as e:
+        print(f"ERRO:     Erro HTTP ao obter token: {e.response.status_code} - {e.response.text}")
+        raise Exception(f"Erro HTTP {e.response.status_code} da API de Token: {e.response.text}") from e
+    except (json.JSONDecodeError, ValueError, KeyError) as e:
+        print(f"ERRO:     Erro ao processar resposta do token: {e}")
+        raise Exception(f"Erro ao processar resposta da API de Token: {e}") from e
+
+
+# Token de acesso em cache, compartilhado por todas as ferramentas do servidor
+_token_cache: Dict[str, Any] = {"access_token": None, "expira_em": 0.0}
+# Renovação em andamento, aguardada por todas as chamadas concorrentes
+_token_renovacao: Optional["asyncio.Task[str]"] = None
+
+
+async def obter_access_token() -> str:
+    """
+    Retorna o token de acesso em cache enquanto ele for válido.
+    Um novo token só é solicitado quando o atual está a menos de
+    TOKEN_EXPIRY_MARGIN segundos do seu expires_in.
+
+    Chamadas concorrentes compartilham uma única renovação: todas aguardam
+    o mesmo POST em /OAuth2/Token e, se ele falhar, todas recebem o erro.
+    """
+    global _token_renovacao
+
+    token = _token_cache["access_token"]
+    if token and time.time() < _token_cache["expira_em"]:
+        return token
+
+    if _token_renovacao is None:
+        _token_renovacao = asyncio.ensure_future(_renovar_access_token())
+        _token_renovacao.add_done_callback(_finalizar_renovacao)
+
+    # shield: o cancelamento de uma chamada não interrompe a renovação das demais
+    return await asyncio.shield(_token_renovacao)
+
+
+def _finalizar_renovacao(task: "asyncio.Task[str]") -> None:
+    global _token_renovacao
+
+    if _token_renovacao is task:
+        _token_renovacao = None
+    if not task.cancelled():
+        task.exception()  # Marca o erro como tratado mesmo sem chamadas aguardando
+
+
+async def _renovar_access_token() -> str:
+    # Um processo anterior (ex.: outro "docker run --rm") pode ter deixado
+    # um token ainda válido no cache em arquivo
+    registro = _ler_token_cache_arquivo().get(_chave_token_cache())
+    if (
+        isinstance(registro, dict)
+        and isinstance(registro.get("access_token"), str)
+        and isinstance(registro.get("expira_em"), (int, float))
+        and time.time() < registro["expira_em"]
+    ):
+        print("INFO:     Reutilizando token do cache em arquivo")
+        _token_cache["access_token"] = registro["access_token"]
+        _token_cache["expira_em"] = registro["expira_em"]
+        return _token_cache["access_token"]
+
+    token_data = await _internal_get_access_token(CLIENT_ID, CLIENT_SECRET)
+    try:
+        expires_in = float(token_data.get("expires_in", TOKEN_DEFAULT_EXPIRES_IN))
+    except (TypeError, ValueError):
+        expires_in = TOKEN_DEFAULT_EXPIRES_IN
+    validade = max(expires_in - TOKEN_EXPIRY_MARGIN, expires_in / 2)
+
+    _token_cache["access_token"] = token_data["access_token"]
+    _token_cache["expira_em"] = time.time() + validade
+    _atualizar_token_cache_arquivo(dict(_token_cache))
+    return _token_cache["access_token"]
+
+
+def _invalidar_access_token(token: str) -> None:
+    """
+    Descarta o token em cache (memória e arquivo), caso ainda seja o token informado.
+    """
+    if _token_cache["access_token"] == token:
+        _token_cache["access_token"] = None
+        _token_cache["expira_em"] = 0.0
+
+    registro = _ler_token_cache_arquivo().get(_chave_token_cache())
+    if isinstance(registro, dict) and registro.get("access_token") == token:
+        _atualizar_token_cache_arquivo(None)
+
+
+def _chave_token_cache() -> str:
+    # O segredo entra no hash para que credenciais trocadas não reaproveitem tokens antigos
+    identificacao = f"{API_BASE_URL}|{CLIENT_ID}|{CLIENT_SECRET}"
+    return hashlib.sha256(identificacao.encode("utf-8")).hexdigest()
+
+
+def _ler_token_cache_arquivo() -> Dict[str, Any]:
+    """
+    Lê o cache de tokens em arquivo (ACERTPIX_TOKEN_CACHE_FILE).
+    O arquivo é ignorado se não existir, estiver corrompido ou puder ser
+    lido por outros usuários.
+    """
+    if not TOKEN_CACHE_FILE:
+        return {}
+
+    try:
+        info = os.stat(TOKEN_CACHE_FILE)
+        if os.name == "posix" and (
+            info.st_mode & 0o077 or info.st_uid != os.getuid()
+        ):
+            print(
+                f"AVISO:    Cache de token ignorado, permissões inseguras em: {TOKEN_CACHE_FILE}"
+            )
+            return {}
+
+        with open(TOKEN_CACHE_FILE, "r", encoding="utf-8") as arquivo:
+            dados = json.load(arquivo)
+        return dados if isinstance(dados, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"ERRO:     Erro ao ler cache de token em arquivo: {e}")
+        return {}
+
+
+def _atualizar_token_cache_arquivo(registro: Optional[Dict[str, Any]]) -> None:
+    """
+    Grava (ou remove, se registro for None) o token deste servidor no cache
+    em arquivo, descartando tokens já expirados. A escrita é atômica e o
+    arquivo é criado com permissão 0600.
+    """
+    if not TOKEN_CACHE_FILE:
+        return
+
+    agora = time.time()
+    dados = {
+        chave: valor
+        for chave, valor in _ler_token_cache_arquivo().items()
+        if isinstance(valor, dict)
+        and isinstance(valor.get("expira_em"), (int, float))
+        and valor["expira_em"] > agora
+    }
+    if registro is None:
+        dados.pop(_chave_token_cache(), None)
+    else:
+        dados[_chave_token_cache()] = registro
+
+    diretorio = os.path.dirname(os.path.abspath(TOKEN_CACHE_FILE))
+    try:
+        os.makedirs(diretorio, mode=0o700, exist_ok=True)
+        # mkstemp cria o arquivo temporário com permissão 0600
+        fd, caminho_temporario = tempfile.mkstemp(dir=diretorio, prefix=".acertpix-token-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as arquivo:
+                json.dump(dados, arquivo)
+            os.replace(caminho_temporario, TOKEN_CACHE_FILE)
+        except BaseException:
+            os.unlink(caminho_temporario)
+            raise
+    except OSError as e:
+        print(f"ERRO:     Erro ao gravar cache de token em arquivo: {e}")
+
+
+async def _requisicao_autenticada(
+    method: str,
+    url: str,
+    familia: str,
+    idempotente: Optional[bool] = None,
+    headers: Optional[Dict[str, str]] = None,
+    **kwargs: Any,
+) -> httpx.Response:
+    """
+    Executa uma chamada autenticada à API usando o token em cache e o
+    timeout da família de endpoint (consultar, obter_laudo, enviar, obter_pdf).
+    Se a API responder 401, o token é invalidado e a chamada é repetida
+    uma única vez com um token novo.
+
+    Chamadas idempotentes (por padrão, apenas GET) também são repetidas em
+    falhas transitórias. Um POST só é repetido quando marcado como
+    idempotente, ou seja, quando é enviado com chave de idempotência.
+
+    Com stream=True, o corpo da resposta não é lido de antemão; quem chama
+    lê em streaming e fecha a resposta (response.aclose()).
+    """
+    if idempotente is None:
+        idempotente = method == "GET"
+
+    async def tentar() -> httpx.Response:
+        access_token = await obter_access_token()
+        response = await _enviar_requisicao(
+            method, url, familia, access_token, headers, **kwargs
+        )
+
+        if response.status_code == 401:
+            print("INFO:     Token recusado pela API (401), renovando token")
+            await response.aclose()
+            _invalidar_access_token(access_token)
+            access_token = await obter_access_token()
+            response = await _enviar_requisicao(
+                method, url, familia, access_token, headers, **kwargs
+            )
+
+        return response
+
+    return await _com_retentativas(f"{method} {url}", idempotente, tentar)
+
+
+async def _com_retentativas(
+    descricao: str,
+    idempotente: bool,
+    enviar: Callable[[], Awaitable[httpx.Response]],
+) -> httpx.Response:
+    """
+    Executa a requisição e, se ela for idempotente, repete-a em erros de rede
+    e respostas transitórias (RETRY_STATUS_CODES), com backoff exponencial
+    limitado e jitter completo. O cabeçalho Retry-After é respeitado e
+    nenhuma espera ultrapassa o prazo da ferramenta.
+    """
+    tentativas = RETRY_MAX_ATTEMPTS if idempotente else 1
+    tentativa = 1
+    while True:
+        erro: Optional[httpx.TransportError] = None
+        response: Optional[httpx.Response] = None
+        try:
+            response = await enviar()
+            if response.status_code not in RETRY_STATUS_CODES:
+                return response
+        except httpx.TransportError as e:
+            erro = e
+
+        if tentativa >= tentativas:
+            break
+
+        espera = _espera_retry_after(response) if response is not None else None
+        if espera is None:
+            limite = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (tentativa - 1))
+            espera = random.uniform(0, limite)
+
+        prazo = _prazo_ferramenta.get()
+        if prazo is not None and time.monotonic() + espera >= prazo:
+            break
+
+        motivo = str(erro) if erro is not None else f"HTTP {response.status_code}"
+        print(
+            f"AVISO:    {descricao} falhou ({motivo}); "
+            f"tentativa {tentativa + 1}/{tentativas} em {espera:.2f}s"
         )
-    ]
+        if response is not None:
+            await response.aclose()
+        await asyncio.sleep(espera)
+        tentativa += 1
+
+    if erro is not None:
+        raise erro
+    return response
+
 
-async def _internal_get_access_token(client_id: str, client_secret: str) -> str:
+def _espera_retry_after(response: httpx.Response) -> Optional[float]:
     """
-    Lógica interna para obter o token de acesso da API.
-    Chamada pelas ferramentas que precisam de autenticação.
-    Levanta exceção em caso de erro.
+    Interpreta o cabeçalho Retry-After (segundos ou data HTTP).
     """
-    url = f"{API_BASE_URL}{TOKEN_ENDPOINT}"
-    payload = {
-        "Scope": "api",
-        "GrantType": "client_credentials",
-        "ClientId": client_id,
-        "ClientSecret": client_secret
-    }
-    headers = {"Content-Type": "application/json", "Accept": "application/json"}
+    valor = response.headers.get("Retry-After")
+    if not valor:
+        return None
 
-    print(f"INFO:     Tentando obter token de: {url}")
+    try:
+        return max(float(valor), 0.0)
+    except ValueError:
+        pass
 
-    async with httpx.AsyncClient(verify=SSL_VERIFY) as client:
-        try:
-            response = await client.post(url, json=payload, headers=headers)
-            print(f"INFO:     Resposta Token Status: {response.status_code}")
+    try:
+        data = email.utils.parsedate_to_datetime(valor)
+    except (TypeError, ValueError):
+        return None
+    if data.tzinfo is None:
+        data = data.replace(tzinfo=datetime.timezone.utc)
+    agora = datetime.datetime.now(datetime.timezone.utc)
+    return max((data - agora).total_seconds(), 0.0)
 
-            response.raise_for_status()
 
-            token_data = response.json()
-            if "access_token" not in token_data:
-                raise ValueError(f"Campo 'access_token' não encontrado na resposta da API de Token: {token_data}")
+async def _enviar_requisicao(
+    method: str,
+    url: str,
+    familia: str,
+    access_token: str,
+    headers_extras: Optional[Dict[str, str]] = None,
+    stream: bool = False,
+    **kwargs: Any,
+) -> httpx.Response:
+    headers = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+        "Authorization": f"Bearer {access_token}",
+        **(headers_extras or {}),
+    }
+    await _rate_limiter_para(familia).adquirir()
+
+    # Com o tamanho exato informado, o corpo em streaming é enviado sem
+    # codificação chunked
+    if isinstance(kwargs.get("content"), CorpoJsonImagens):
+        headers["Content-Length"] = str(len(kwargs["content"]))
 
-            token = token_data["access_token"]
-            print(f"INFO:     Token obtido com sucesso (prefixo): {token[:10]}...")
-            return token
-        except httpx.RequestError as e:
-            print(f"ERRO:     Erro de rede ao obter token: {e}")
-            raise Exception(f"Erro de rede ao conectar com {e.request.url!r}: {e}") from e
-        except httpx.HTTPStatusError as e:
-            print(f"ERRO:     Erro HTTP ao obter token: {e.response.status_code} - {e.response.text}")
-            raise Exception(f"Erro HTTP {e.response.status_code} da API de Token: {e.response.text}") from e
-        except (json.JSONDecodeError, ValueError, KeyError) as e:
-            print(f"ERRO:     Erro ao processar resposta do token: {e}")
-            raise Exception(f"Erro ao processar resposta da API de Token: {e}") from e
+    client = obter_http_client()
+    try:
+        request = client.build_request(
+            method, url, headers=headers, timeout=_timeout_para(familia), **kwargs
+        )
+        return await _com_circuit_breaker(url, lambda: client.send(request, stream=stream))
+    except httpx.TimeoutException as e:
+        # As exceções de timeout do httpx não trazem mensagem; mantém o tipo original
+        raise type(e)(
+            f"Tempo limite excedido ({type(e).__name__}) em {method} {url}",
+            request=e.request,
+        ) from e
 
 
-async def consultar_facematch(id: int) -> Dict[str, Any]:
+@_com_prazo
+async def consultar_facematch(id: int, forcarAtualizacao: bool = False) -> Dict[str, Any]:
     """
     Consulta os dados de facematch por ID na API.
     """
     try:
-        # 1. Obter o token de acesso usando a lógica interna
-        access_token = await _internal_get_access_token(CLIENT_ID, CLIENT_SECRET)
-        print(f"Token gerado: {access_token[:10]}...")
-        
+        # Cache das consultas; forcarAtualizacao consulta a API mesmo assim
+        em_cache = None if forcarAtualizacao else _consulta_em_cache(("consultar", id))
+        if em_cache is not None:
+            print(f"INFO:     Consulta facematch do id {id} atendida pelo cache")
+            return {"status": "sucesso", "resultado": em_cache}
+
         url = f"{API_BASE_URL}{BIOMETRIA_CONSULTAR_ENDPOINT}/{id}"
         print(url)
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Bearer {access_token}",
-        }
         
         print(f"INFO:     Consultando facematch em: {url}")
 
-        # 2. Fazer a chamada GET para a API de Facematch
-        async with httpx.AsyncClient(verify=SSL_VERIFY) as client:
-            response = await client.get(url, headers=headers)
+        async def requisitar() -> Any:
+            # Chamada GET autenticada (token em cache) para a API de Facematch
+            response = await _requisicao_autenticada("GET", url, "consultar")
             print(f"INFO:     Resposta Facematch Status: {response.status_code}")
+            _registrar_nao_encontrado(("consultar", id), response)
             response.raise_for_status()
             biometria_data = response.json()
-        
-        print(f"Facematch response status: {response.status_code}")
-        
+            _guardar_consulta(("consultar", id), response, _resultado_finalizado(biometria_data))
+
+            print(f"Facematch response status: {response.status_code}")
+            return biometria_data
+
+        # Chamadas simultâneas para a mesma chave compartilham uma só requisição
+        biometria_data = await _requisicao_compartilhada(("consultar", id), requisitar)
+
         return {
             "status": "sucesso",
             "resultado": biometria_data
@@ -160,40 +1689,47 @@ async def consultar_facematch(id: int) -> Dict[str, Any]:
         return {"status": "erro", "mensagem": f"Erro ao consultar facematch: {str(e)}"}
 
 
-async def enviar_facematch(chave: str, cpf: str, imagemFrente: str, imagemVerso: str, imagemSelfie: str) -> Dict[str, Any]:
+@_com_prazo
+async def enviar_facematch(chave: str, cpf: str, caminhoImagemFrente: ImagemEntrada, caminhoImagemVerso: ImagemEntrada, caminhoImagemSelfie: ImagemEntrada, chaveIdempotencia: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Envia as imagens para facematch. As imagens são informadas pelos caminhos
+    dos arquivos, lidas e convertidas para base64 em blocos durante o envio.
+    """
     try:
-        access_token = await _internal_get_access_token(CLIENT_ID, CLIENT_SECRET)
-        print(f"\nToken gerado: {access_token}\n")
-    
         url = f"{API_BASE_URL}{BIOMETRIA_ENVIAR_ENDPOINT}"
-    
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Bearer {access_token}",
-        }
-        # params = {"chave": chave} # Parâmetros GET vão em 'params' com httpx
-            
-        content = {
-            "chave": chave,
-            "cpf": cpf,
-            "imagemFrente": imagemFrente,
-            "imagemVerso": imagemVerso,
-            "imagemSelfie": imagemSelfie
+
+        imagens = {
+            "imagemFrente": caminhoImagemFrente,
+            "imagemVerso": caminhoImagemVerso,
+            "imagemSelfie": caminhoImagemSelfie
         }
-        
-        print(f"INFO:     enviando documento para facematch em: {url}")
 
-        # 3. Fazer a chamada GET para a API
-        async with httpx.AsyncClient(verify=SSL_VERIFY) as client:
-            response = await client.post(url, headers=headers, json=content)
+        # Validação local: entradas inválidas são recusadas antes de qualquer
+        # chamada à API
+        imagens = await _validar_envio(cpf, imagens)
+
+        corpo = await CorpoJsonImagens.criar({"chave": chave, "cpf": cpf, **imagens}, imagens)
+
+        # Reserva o tamanho do corpo (o máximo possível, para as imagens ainda
+        # não lidas) antes de trazer qualquer imagem para a memória; se o limite
+        # de envios simultâneos (quantidade ou bytes) estiver cheio, aguarda na fila
+        async with _admissao_envios.reservar(len(corpo)):
+            await corpo.preparar()
+            print(f"INFO:     enviando documento para facematch em: {url}")
+
+            # Com chave de idempotência a API descarta envios duplicados, então a
+            # chamada pode ser repetida em falhas transitórias; sem ela, nunca é
+            headers = {"Idempotency-Key": chaveIdempotencia} if chaveIdempotencia else None
+            response = await _requisicao_autenticada("POST", url, "enviar", idempotente=bool(chaveIdempotencia), headers=headers, content=corpo)
             print(f"INFO:     Resposta ocr Status: {response.status_code}")
             response.raise_for_status() # Levanta exceção para status >= 400
             facematch_data = response.json()
-        
-        print(f"facematch response status: {response.status_code}")
-        print(f"facematch response text: {response.text}")
-        
+            # Novo envio: o que estava em cache para a chave e o id devolvido deixa de valer
+            _invalidar_consultas(chave, facematch_data)
+
+            print(f"facematch response status: {response.status_code}")
+            print(f"facematch response text: {response.text}")
+
         return {
         "status": "sucesso",
         "resultado": facematch_data
@@ -203,49 +1739,748 @@ async def enviar_facematch(chave: str, cpf: str, imagemFrente: str, imagemVerso:
         print(f"ERRO:     Falha na ferramenta 'enviar-facematch': {e}")
         return {"status": "erro", "mensagem": f"Erro ao enviar facematch: {str(e)}"}
 
-def converter_para_base64(caminhoImagem: str) -> str:
+_executor_imagens: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def _reduzir_imagem(origem: Union[str, bytes]) -> Optional[bytes]:
+    """
+    Aplica a orientação EXIF, reduz a imagem (caminho do arquivo ou conteúdo
+    em base64) para IMAGE_MAX_DIMENSION e recomprime em JPEG, devolvendo o
+    resultado em base64. Retorna None quando a original já serve: JPEG sem
+    rotação dentro da dimensão máxima, ou resultado que não ficaria menor.
+    """
+    from PIL import Image, ImageOps
+
+    if isinstance(origem, bytes):
+        original = base64.b64decode(origem)
+        arquivo, tamanho_original = io.BytesIO(original), len(original)
+    else:
+        arquivo, tamanho_original = origem, os.path.getsize(origem)
+
+    with Image.open(arquivo) as imagem:
+        orientacao = imagem.getexif().get(0x0112, 1)  # Tag EXIF Orientation
+        largura, altura = imagem.size
+        escala = min(IMAGE_MAX_DIMENSION / max(largura, altura), 1.0)
+        if escala == 1.0 and orientacao == 1 and imagem.format == "JPEG":
+            return None
+
+        # Em JPEG, decodifica direto em escala reduzida (1/2, 1/4 ou 1/8)
+        imagem.draft("RGB", (math.ceil(largura * escala), math.ceil(altura * escala)))
+        reduzida = ImageOps.exif_transpose(imagem)
+        reduzida.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+        if reduzida.mode != "RGB":
+            reduzida = reduzida.convert("RGB")
+        saida = io.BytesIO()
+        reduzida.save(saida, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+
+    dados = saida.getvalue()
+    if orientacao == 1 and len(dados) >= tamanho_original:
+        return None
+    return base64.b64encode(dados)
+
+
+async def _preprocessar_imagem(origem: Union[str, bytes]) -> Optional[bytes]:
+    """
+    Reduz a imagem em um pool de threads (o Pillow libera o GIL ao
+    decodificar, redimensionar e codificar). Devolve o JPEG reduzido em
+    base64 ou None, se não houver ganho ou algo falhar.
+    """
+    global _executor_imagens
+
+    nome = origem if isinstance(origem, str) else "informada em base64"
+    if _executor_imagens is None:
+        _executor_imagens = concurrent.futures.ThreadPoolExecutor(
+            max_workers=IMAGE_PREPROCESS_WORKERS, thread_name_prefix="acertpix-imagens"
+        )
     try:
-        with open(caminhoImagem, "rb") as imagem:
-            imagem_bytes = imagem.read()
-            imagem_base64 = base64.b64encode(imagem_bytes).decode("utf-8")
-            return imagem_base64
+        reduzida = await asyncio.get_running_loop().run_in_executor(
+            _executor_imagens, _reduzir_imagem, origem
+        )
     except Exception as e:
-        print(f"Erro ao converter imagem: {e}")
-        return ""  
+        print(f"AVISO:    Pré-processamento de {nome} falhou; enviando a original: {e}")
+        return None
+    if reduzida is not None:
+        print(f"INFO:     Imagem {nome} reduzida para {len(reduzida)} bytes em base64")
+    return reduzida
 
 
-async def obter_pdf_facematch(id: int, caminho_salvar: str) -> Dict[str, Any]:
+def _preprocessamento_ativo() -> bool:
+    global IMAGE_PREPROCESS
+
+    if IMAGE_PREPROCESS and importlib.util.find_spec("PIL") is None:
+        print(
+            "AVISO:    ACERTPIX_IMAGE_PREPROCESS ativo, mas o pacote 'Pillow' não está instalado; enviando as imagens originais"
+        )
+        IMAGE_PREPROCESS = False
+    return IMAGE_PREPROCESS
+
+
+def fechar_executor_imagens() -> None:
+    """
+    Encerra o pool de pré-processamento de imagens, se tiver sido criado.
+    """
+    global _executor_imagens
+
+    if _executor_imagens is not None:
+        _executor_imagens.shutdown(wait=False, cancel_futures=True)
+        _executor_imagens = None
+
+
+_BASE64_VALIDO = re.compile(rb"[A-Za-z0-9+/]*={0,2}")
+
+
+def _base64_valido(texto: Any) -> Optional[bytes]:
     """
-    Obtem pdf do facematch por ID na API.
+    Devolve o texto como bytes se for base64 válido (quebras de linha e
+    espaços são ignorados), sem decodificá-lo; senão, None.
     """
+    if not isinstance(texto, str):
+        return None
     try:
-        # 1. Obter o token de acesso usando a lógica interna
-        access_token = await _internal_get_access_token(CLIENT_ID, CLIENT_SECRET)
-        print(f"Token gerado: {access_token[:10]}...")
-        
+        dados = b"".join(texto.encode("ascii").split())
+    except UnicodeEncodeError:
+        return None
+    if not dados or len(dados) % 4 or not _BASE64_VALIDO.fullmatch(dados):
+        return None
+    return dados
+
+
+def _interpretar_imagem(imagem: ImagemEntrada) -> Tuple[Optional[str], Optional[bytes]]:
+    """
+    Identifica a forma da imagem informada e devolve (caminho ou URL, None)
+    ou (None, base64). Recursos MCP podem vir como recurso embutido
+    ({"type": "resource", "resource": {...}}), conteúdo de recurso
+    ({"uri": ..., "blob": ...}) ou conteúdo de imagem ({"type": "image",
+    "data": ...}); sem o conteúdo, só URIs file:// e http(s) são aceitas.
+    """
+    conteudo = None
+    if isinstance(imagem, dict):
+        recurso = imagem.get("resource") or imagem
+        if not isinstance(recurso, dict):
+            raise ValueError(f'campo "resource" do recurso de imagem deve ser um objeto ({type(recurso).__name__})')
+        for nome in ("uri", "blob", "data"):
+            if recurso.get(nome) is not None and not isinstance(recurso[nome], str):
+                raise ValueError(
+                    f'campo "{nome}" do recurso de imagem deve ser texto ({type(recurso[nome]).__name__})'
+                )
+        conteudo = recurso.get("blob") or recurso.get("data")
+        imagem = recurso.get("uri") or ""
+        if not conteudo and not imagem.startswith(("file://", "http://", "https://")):
+            raise ValueError(
+                f"recurso de imagem sem conteúdo em base64 nem URI file:// ou http(s) ({imagem or 'sem URI'})"
+            )
+    elif not isinstance(imagem, str):
+        raise ValueError(f"formato de imagem não suportado ({type(imagem).__name__})")
+    elif imagem.startswith("data:"):
+        cabecalho, _, conteudo = imagem.partition(",")
+        if not cabecalho.endswith(";base64"):
+            raise ValueError("a URI data: da imagem precisa estar em base64")
+    elif len(imagem) > 4096:
+        # Maior que qualquer caminho de arquivo (PATH_MAX): só pode ser a imagem
+        conteudo = imagem
+
+    if conteudo is None:
+        if imagem.startswith("file://"):
+            return urllib.request.url2pathname(urllib.parse.urlparse(imagem).path), None
+        return imagem, None
+    dados = _base64_valido(conteudo)
+    if dados is None:
+        raise ValueError("conteúdo da imagem não é base64 válido")
+    return None, dados
+
+
+class EntradaInvalidaError(ValueError):
+    """
+    Envio recusado na validação local, antes de qualquer chamada à API.
+    """
+
+
+def validar_cpf(cpf: str) -> None:
+    """
+    Confere o CPF, com ou sem pontuação: 11 dígitos, não todos iguais, e os
+    dois dígitos verificadores.
+    """
+    digitos = str(cpf).strip().replace(".", "").replace("-", "")
+    if not (digitos.isascii() and digitos.isdigit()):
+        raise EntradaInvalidaError("CPF inválido: deve conter apenas dígitos, pontos e hífen")
+    if len(digitos) != 11:
+        raise EntradaInvalidaError(f"CPF inválido: deve ter 11 dígitos (informados: {len(digitos)})")
+    if digitos == digitos[0] * 11:
+        raise EntradaInvalidaError("CPF inválido: todos os dígitos são iguais")
+    numeros = [int(digito) for digito in digitos]
+    for posicao in (9, 10):
+        soma = sum(n * peso for n, peso in zip(numeros, range(posicao + 1, 1, -1)))
+        if soma * 10 % 11 % 10 != numeros[posicao]:
+            raise EntradaInvalidaError(f"CPF inválido: o {posicao - 8}º dígito verificador não confere")
+
+
+def _formato_imagem(cabecalho: bytes) -> Optional[str]:
+    """
+    Identifica o formato da imagem pela assinatura nos primeiros 12 bytes.
+    """
+    if cabecalho.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if cabecalho.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if cabecalho[:4] == b"RIFF" and cabecalho[8:12] == b"WEBP":
+        return "WebP"
+    if cabecalho.startswith(b"BM"):
+        return "BMP"
+    if cabecalho.startswith((b"II*\x00", b"MM\x00*")):
+        return "TIFF"
+    if cabecalho[4:8] == b"ftyp" and cabecalho[8:12] in (b"heic", b"heix", b"heif", b"mif1", b"msf1"):
+        return "HEIC"
+    return None
+
+
+def _validar_imagem(campo: str, imagem: ImagemEntrada, preprocessar: bool) -> Union[str, bytes]:
+    """
+    Valida uma imagem do envio sem acessar a rede: forma da entrada,
+    existência do arquivo, tamanho e assinatura do formato. Devolve a imagem
+    normalizada para _planejar_imagem: base64 em bytes, URL ou caminho.
+    """
+    try:
+        caminhoImagem, dados = _interpretar_imagem(imagem)
+    except ValueError as e:
+        raise EntradaInvalidaError(f"{campo}: {e}") from None
+    if dados is None and _e_url(caminhoImagem):
+        # Tamanho e formato conferidos no download (ver _baixar_imagem)
+        return caminhoImagem
+
+    if dados is None:
+        try:
+            info = os.stat(caminhoImagem)
+            if not stat.S_ISREG(info.st_mode):
+                raise EntradaInvalidaError(f"{campo}: {caminhoImagem} não é um arquivo")
+            with open(caminhoImagem, "rb") as arquivo:
+                cabecalho = arquivo.read(12)
+            tamanho = info.st_size
+        except OSError as e:
+            # Sem arquivo com esse nome, o texto pode ser uma imagem pequena em
+            # base64, se decodificado tiver a assinatura de uma imagem; senão
+            # ("imagens/frente12") é um caminho que não existe
+            dados = _base64_valido(caminhoImagem)
+            if dados is not None and _formato_imagem(base64.b64decode(dados[:16])) is None:
+                dados = None
+            if dados is None:
+                if isinstance(e, FileNotFoundError):
+                    raise EntradaInvalidaError(f"{campo}: arquivo não encontrado: {caminhoImagem}") from None
+                raise EntradaInvalidaError(f"{campo}: não foi possível ler {caminhoImagem}: {e.strerror}") from None
+    if dados is not None:
+        cabecalho = base64.b64decode(dados[:16])
+        tamanho = len(dados) // 4 * 3 - dados[-2:].count(b"=")
+
+    if not tamanho:
+        raise EntradaInvalidaError(f"{campo}: imagem vazia")
+    if IMAGE_MAX_BYTES and tamanho > IMAGE_MAX_BYTES and not preprocessar:
+        raise EntradaInvalidaError(
+            f"{campo}: imagem de {tamanho / 2**20:.1f} MiB excede o limite de "
+            f"{IMAGE_MAX_BYTES / 2**20:.1f} MiB (ACERTPIX_IMAGE_MAX_BYTES)"
+        )
+    if _formato_imagem(cabecalho) is None:
+        raise EntradaInvalidaError(f"{campo}: formato de imagem não reconhecido (aceitos: {FORMATOS_IMAGEM})")
+    return caminhoImagem if dados is None else dados
+
+
+async def _validar_envio(cpf: str, imagens: Dict[str, ImagemEntrada]) -> Dict[str, Union[str, bytes]]:
+    """
+    Validação local de um envio (CPF e imagens), antes de qualquer chamada à
+    API: entradas inválidas falham com EntradaInvalidaError sem gastar a
+    obtenção de token nem o envio. Devolve as imagens normalizadas, com os
+    campos vazios mantidos vazios.
+    """
+    if cpf:
+        validar_cpf(cpf)
+    preprocessar = _preprocessamento_ativo()
+    preenchidas = {campo: imagem for campo, imagem in imagens.items() if imagem}
+    validadas = {}
+    if preenchidas:
+        # Um único salto para a thread com os acessos ao disco de todas as imagens
+        validadas = await asyncio.to_thread(
+            lambda: {
+                campo: _validar_imagem(campo, imagem, preprocessar)
+                for campo, imagem in preenchidas.items()
+            }
+        )
+    return {campo: validadas.get(campo, "") for campo in imagens}
+
+
+def _ler_base64(caminhoImagem: str) -> bytes:
+    with open(caminhoImagem, "rb") as imagem:
+        return base64.b64encode(imagem.read())
+
+
+async def _planejar_imagem(imagem: Union[str, bytes]) -> Tuple[
+    Union[str, bytes], int, Optional[Callable[[], Awaitable[Tuple[Union[str, bytes], int]]]]
+]:
+    """
+    Prepara uma imagem já validada (ver _validar_imagem) para o corpo do
+    envio sem trazê-la para a memória: só stat, consulta ao cache e, para
+    URLs, o HEAD. Devolve o valor e o tamanho para o corpo (base64 já em
+    memória, ou caminho ou URL lidos em streaming durante o envio) e, quando
+    a imagem ainda precisa ser lida, pré-processada ou baixada para a
+    memória, a função que faz isso; nesse caso o tamanho é o máximo que ela
+    pode ocupar, e a função só é chamada depois da reserva na admissão dos
+    envios (ver CorpoJsonImagens.preparar).
+    """
+    preprocessar = _preprocessamento_ativo()
+    if isinstance(imagem, bytes):
+        # O pré-processamento só devolve imagens menores que a original
+        return imagem, len(imagem), functools.partial(_preparar_base64, imagem) if preprocessar else None
+    if _e_url(imagem):
+        try:
+            return await _planejar_url(imagem)
+        except (httpx.HTTPError, ValueError) as e:
+            raise ValueError(f"Não foi possível baixar a imagem {imagem}: {e}") from e
+
+    caminhoImagem = imagem
+    info = await asyncio.to_thread(os.stat, caminhoImagem)
+    chave = (
+        info.st_dev,
+        info.st_ino,
+        info.st_mtime_ns,
+        info.st_size,
+        (IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY) if preprocessar else None,
+    )
+    preparada = _cache_imagens.obter(chave)
+    if preparada is not None:
+        return preparada, len(preparada), None
+    if not preprocessar and 4 * math.ceil(info.st_size / 3) > _cache_imagens.max_bytes_entrada:
+        return caminhoImagem, info.st_size, None
+    return caminhoImagem, info.st_size, functools.partial(_ler_imagem, caminhoImagem, chave)
+
+
+async def _ler_imagem(caminhoImagem: str, chave: Tuple[Any, ...]) -> Tuple[Union[str, bytes], int]:
+    """
+    Lê para a memória (e para o cache) a imagem em arquivo, pré-processada
+    quando ativado, já em base64. A original que o pré-processamento não
+    reduziu e que não cabe no cache segue em streaming.
+    """
+    # Outro envio pode ter lido a mesma imagem enquanto este aguardava na fila
+    preparada = _cache_imagens.obter(chave)
+    if preparada is not None:
+        return preparada, len(preparada)
+    tamanho = chave[3]
+    if chave[-1] is not None:
+        preparada = await _preprocessar_imagem(caminhoImagem)
+        _conferir_imagem_reduzida(caminhoImagem, tamanho, preparada)
+    if preparada is None:
+        if 4 * math.ceil(tamanho / 3) > _cache_imagens.max_bytes_entrada:
+            return caminhoImagem, tamanho
+        preparada = await asyncio.to_thread(_ler_base64, caminhoImagem)
+    _cache_imagens.guardar(chave, preparada)
+    return preparada, len(preparada)
+
+
+def _conferir_imagem_reduzida(nome: str, tamanho: int, preparada: Optional[bytes]) -> None:
+    """
+    Com o pré-processamento ativo, _validar_imagem aceita imagens acima de
+    IMAGE_MAX_BYTES contando com a redução. A que não ficou dentro do limite
+    (o Pillow não a abriu, JPEG já na dimensão máxima, resultado não menor)
+    é recusada aqui, antes da chamada à API.
+    """
+    final = tamanho if preparada is None else len(preparada) // 4 * 3
+    if IMAGE_MAX_BYTES and final > IMAGE_MAX_BYTES:
+        raise EntradaInvalidaError(
+            f"imagem {nome} de {final / 2**20:.1f} MiB excede o limite de "
+            f"{IMAGE_MAX_BYTES / 2**20:.1f} MiB (ACERTPIX_IMAGE_MAX_BYTES) mesmo após o pré-processamento"
+        )
+
+
+async def _preparar_base64(dados: bytes, conferir_limite: bool = True) -> Tuple[bytes, int]:
+    """
+    Imagem recebida já em base64: vai para o corpo como está, sem nova
+    codificação. Com o pré-processamento ativo, é reduzida como as lidas do
+    disco, com o resultado em cache pelo hash do conteúdo, e conferida contra
+    IMAGE_MAX_BYTES (exceto as baixadas de URL, limitadas no download).
+    """
+    if not _preprocessamento_ativo():
+        return dados, len(dados)
+
+    resumo = await asyncio.to_thread(lambda: hashlib.sha256(dados).digest())
+    chave = (resumo, IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY)
+    preparada = _cache_imagens.obter(chave)
+    if preparada is None:
+        preparada = await _preprocessar_imagem(dados)
+        if conferir_limite:
+            _conferir_imagem_reduzida(
+                "informada em base64", len(dados) // 4 * 3 - dados[-2:].count(b"="), preparada
+            )
+        if preparada is None:
+            return dados, len(dados)
+        _cache_imagens.guardar(chave, preparada)
+    return preparada, len(preparada)
+
+
+def _e_url(caminhoImagem: str) -> bool:
+    return caminhoImagem.startswith(("http://", "https://"))
+
+
+# Downloads de imagens em andamento, em todos os envios
+_downloads_imagens = asyncio.Semaphore(IMAGE_URL_MAX_CONCURRENT)
+
+
+async def _planejar_url(url: str) -> Tuple[
+    str, int, Optional[Callable[[], Awaitable[Tuple[Union[str, bytes], int]]]]
+]:
+    """
+    Imagem informada por URL http(s). Se o HEAD informa o tamanho, devolve a
+    URL (após redirecionamentos) e o tamanho, e o download é feito em
+    streaming durante o envio, depois de conferidos o início e o tamanho
+    (ver _conferir_inicio_url). Sem o tamanho, ou com o pré-processamento
+    ativo, a imagem será baixada para a memória (ver _baixar_imagem_para_memoria),
+    com até IMAGE_URL_MAX_BYTES.
+    """
+    if not _preprocessamento_ativo():
+        async with _downloads_imagens:
+            response = await obter_http_client().head(
+                url,
+                headers={"Accept-Encoding": "identity"},
+                timeout=_timeout_para("enviar"),
+                follow_redirects=True,
+            )
+        tamanho = response.headers.get("Content-Length")
+        if response.is_success and tamanho and tamanho.isdigit():
+            if int(tamanho) > IMAGE_URL_MAX_BYTES:
+                raise ValueError(f"imagem maior que o limite de {IMAGE_URL_MAX_BYTES} bytes")
+            await _conferir_inicio_url(str(response.url), int(tamanho))
+            return str(response.url), int(tamanho), None
+    return url, IMAGE_URL_MAX_BYTES, functools.partial(_baixar_imagem_para_memoria, url)
+
+
+async def _conferir_inicio_url(url: str, tamanho: int) -> None:
+    """
+    Antes da admissão do envio e de qualquer chamada à API, lê só o início
+    da imagem (GET com Range dos 12 primeiros bytes) e confere a assinatura
+    do formato e o tamanho total, pelo Content-Range (ou pelo Content-Length,
+    se o servidor ignorar o Range), contra o informado no HEAD.
+    """
+    cabecalho = b""
+    async with _downloads_imagens:
+        async with obter_http_client().stream(
+            "GET",
+            url,
+            headers={"Accept-Encoding": "identity", "Range": "bytes=0-11"},
+            timeout=_timeout_para("enviar"),
+            follow_redirects=True,
+        ) as response:
+            response.raise_for_status()
+            if response.status_code == 206:
+                total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            else:
+                total = response.headers.get("Content-Length", "")
+            async for trecho in response.aiter_bytes():
+                cabecalho += trecho
+                if len(cabecalho) >= 12:
+                    break
+    if total.isdigit() and int(total) != tamanho:
+        raise ValueError(f"tamanho da imagem ({total} bytes) difere do informado no HEAD ({tamanho} bytes)")
+    if _formato_imagem(cabecalho[:12]) is None:
+        raise ValueError(f"formato de imagem não reconhecido (aceitos: {FORMATOS_IMAGEM})")
+
+
+async def _baixar_imagem_para_memoria(url: str) -> Tuple[bytes, int]:
+    try:
+        dados = bytearray()
+        async for trecho in _baixar_imagem(url):
+            dados += trecho
+    except (httpx.HTTPError, ValueError) as e:
+        raise ValueError(f"Não foi possível baixar a imagem {url}: {e}") from e
+    return await _preparar_base64(base64.b64encode(dados), conferir_limite=False)
+
+
+async def _baixar_imagem(url: str, tamanho: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    Baixa a imagem com o cliente compartilhado, trecho a trecho, dentro do
+    limite de IMAGE_URL_MAX_BYTES. Com `tamanho`, confere que o conteúdo
+    recebido tem exatamente o tamanho esperado.
+    """
+    limite = IMAGE_URL_MAX_BYTES if tamanho is None else tamanho
+    recebidos = 0
+    cabecalho = b""
+    async with _downloads_imagens:
+        async with obter_http_client().stream(
+            "GET",
+            url,
+            headers={"Accept-Encoding": "identity"},
+            timeout=_timeout_para("enviar"),
+            follow_redirects=True,
+        ) as response:
+            response.raise_for_status()
+            async for trecho in response.aiter_bytes():
+                if len(cabecalho) < 12:
+                    cabecalho += trecho[: 12 - len(cabecalho)]
+                    if len(cabecalho) == 12 and _formato_imagem(cabecalho) is None:
+                        raise ValueError(f"formato de imagem não reconhecido (aceitos: {FORMATOS_IMAGEM})")
+                recebidos += len(trecho)
+                if recebidos > limite:
+                    break
+                yield trecho
+    if recebidos > limite:
+        if tamanho is None:
+            raise ValueError(f"imagem maior que o limite de {IMAGE_URL_MAX_BYTES} bytes")
+        raise OSError(f"A imagem {url} foi alterada durante o envio")
+    if tamanho is not None and recebidos != tamanho:
+        raise OSError(f"A imagem {url} foi alterada durante o envio")
+
+
+async def _baixar_base64(url: str, tamanho: int) -> AsyncIterator[bytes]:
+    """
+    Repassa o download da imagem para o corpo do envio, convertido para
+    base64 em blocos de BASE64_CHUNK_SIZE bytes, sem arquivo temporário.
+    """
+    pendente = bytearray()
+    async for trecho in _baixar_imagem(url, tamanho):
+        pendente += trecho
+        if len(pendente) >= BASE64_CHUNK_SIZE:
+            corte = len(pendente) - len(pendente) % 3
+            yield base64.b64encode(pendente[:corte])
+            del pendente[:corte]
+    if pendente:
+        yield base64.b64encode(pendente)
+
+
+class _LeitorImagem:
+    """
+    Lê uma imagem em blocos de BASE64_CHUNK_SIZE bytes (múltiplo de 3) e
+    converte cada bloco para base64 em uma thread, mantendo sempre um bloco
+    pronto à frente do envio. A leitura começa assim que o leitor é criado.
+    """
+
+    def __init__(self, caminhoImagem: str, tamanho: int):
+        self.caminhoImagem = caminhoImagem
+        self.restante = tamanho
+        self._arquivo = None
+        self._proximo: Optional["asyncio.Future[bytes]"] = None
+        self._agendar()
+
+    def _agendar(self) -> None:
+        self._proximo = None
+        if self.restante:
+            self._proximo = asyncio.ensure_future(asyncio.to_thread(self._ler_bloco))
+
+    def _ler_bloco(self) -> bytes:
+        if self._arquivo is None:
+            self._arquivo = open(self.caminhoImagem, "rb")
+        bloco = self._arquivo.read(min(BASE64_CHUNK_SIZE, self.restante))
+        if not bloco:
+            raise OSError(f"A imagem {self.caminhoImagem} foi alterada durante o envio")
+        self.restante -= len(bloco)
+        return base64.b64encode(bloco)
+
+    async def blocos(self) -> AsyncIterator[bytes]:
+        while self._proximo is not None:
+            # Protegida do cancelamento: a thread segue até o fim de qualquer
+            # forma e fechar() precisa esperar por ela
+            bloco = await asyncio.shield(self._proximo)
+            self._agendar()
+            yield bloco
+
+    async def fechar(self) -> None:
+        if self._proximo is not None:
+            # A leitura em andamento na thread não pode ser interrompida;
+            # espera terminar antes de fechar o arquivo
+            await asyncio.wait([self._proximo])
+            if not self._proximo.cancelled():
+                self._proximo.exception()
+        if self._arquivo is not None:
+            await asyncio.to_thread(self._arquivo.close)
+
+
+class CorpoJsonImagens:
+    """
+    Corpo JSON de envio transmitido em streaming. O esqueleto do JSON é
+    montado na criação e o tamanho final é conhecido de antemão (enviado em
+    Content-Length). Ao iniciar a transmissão, todas as imagens em arquivo
+    passam a ser lidas em paralelo, em threads, enquanto o esqueleto já está
+    sendo enviado; as informadas por URL são baixadas ao chegar a sua vez.
+    Pode ser percorrido mais de uma vez, o que permite repetir a requisição.
+    """
+
+    def __init__(
+        self,
+        content: Dict[str, Any],
+        tamanhos: Dict[str, int],
+        pendentes: Optional[Dict[str, Callable[[], Awaitable[Tuple[Union[str, bytes], int]]]]] = None,
+    ):
+        self._content = content
+        self._tamanhos = tamanhos
+        self._pendentes = pendentes or {}
+        self._montar()
+
+    def _montar(self) -> None:
+        self._partes: List[Union[bytes, Tuple[str, int]]] = []
+        esqueleto = "{"
+        for indice, (campo, valor) in enumerate(self._content.items()):
+            esqueleto += (", " if indice else "") + json.dumps(campo) + ": "
+            if campo not in self._tamanhos:
+                esqueleto += json.dumps(valor)
+            elif self._tamanhos[campo]:
+                # Imagem já em base64 na memória ou arquivo (ou URL) lido durante o envio
+                parte = valor if isinstance(valor, bytes) else (valor, self._tamanhos[campo])
+                self._partes += [(esqueleto + '"').encode("utf-8"), parte]
+                esqueleto = '"'
+            else:
+                esqueleto += '""'
+        self._partes.append((esqueleto + "}").encode("utf-8"))
+
+    @classmethod
+    async def criar(
+        cls, content: Dict[str, Any], campos_imagem: Iterable[str]
+    ) -> "CorpoJsonImagens":
+        """
+        Cria o corpo planejando as imagens em paralelo, sem lê-las para a
+        memória (ver _planejar_imagem). Até preparar(), o tamanho (len) é o
+        máximo que o corpo pode ter.
+        """
+        content = dict(content)
+        tamanhos = {campo: 0 for campo in campos_imagem}
+        pendentes = {}
+        preenchidos = [campo for campo in tamanhos if content[campo]]
+        planejadas = await asyncio.gather(
+            *(_planejar_imagem(content[campo]) for campo in preenchidos)
+        )
+        for campo, (valor, tamanho, preparar) in zip(preenchidos, planejadas):
+            content[campo], tamanhos[campo] = valor, tamanho
+            if preparar is not None:
+                pendentes[campo] = preparar
+        return cls(content, tamanhos, pendentes)
+
+    async def preparar(self) -> None:
+        """
+        Lê, pré-processa ou baixa para a memória, em paralelo e fora do loop
+        de eventos, as imagens que precisam disso. Chamado depois da reserva
+        na admissão dos envios, feita com o tamanho máximo do corpo.
+        """
+        campos = list(self._pendentes)
+        preparadas = await asyncio.gather(*(self._pendentes[campo]() for campo in campos))
+        for campo, (valor, tamanho) in zip(campos, preparadas):
+            self._content[campo], self._tamanhos[campo] = valor, tamanho
+        self._pendentes = {}
+        self._montar()
+
+    def __len__(self) -> int:
+        return sum(
+            len(parte) if isinstance(parte, bytes) else 4 * math.ceil(parte[1] / 3)
+            for parte in self._partes
+        )
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        if self._pendentes:
+            raise RuntimeError("Corpo do envio com imagens não preparadas (ver preparar)")
+        leitores = {
+            indice: _LeitorImagem(*parte)
+            for indice, parte in enumerate(self._partes)
+            if not isinstance(parte, bytes) and not _e_url(parte[0])
+        }
+        try:
+            for indice, parte in enumerate(self._partes):
+                if isinstance(parte, bytes):
+                    yield parte
+                elif indice in leitores:
+                    async for bloco in leitores[indice].blocos():
+                        yield bloco
+                else:
+                    # O download só começa quando o envio chega ao campo: cada
+                    # envio ocupa no máximo uma vaga de download por vez
+                    async for bloco in _baixar_base64(*parte):
+                        yield bloco
+        finally:
+            for leitor in leitores.values():
+                await leitor.fechar()
+
+
+@_com_prazo
+async def obter_pdf_facematch(
+    id: int,
+    caminho_salvar: Optional[str],
+    forcarAtualizacao: bool = False,
+    retornarConteudo: bool = False,
+) -> Dict[str, Any]:
+    """
+    Obtem pdf do facematch por ID na API. Com retornarConteudo, o PDF não é
+    gravado em caminho_salvar: vem em base64 no campo "pdf" do resultado,
+    limitado a PDF_EMBED_MAX_BYTES.
+    """
+    try:
+        # Id que a API acabou de responder como inexistente falha na hora
+        if not forcarAtualizacao:
+            _recusar_nao_encontrado(("obter_pdf", id))
+
         url = f"{API_BASE_URL}/Biometria/ObterPdf/{id}"
         print(url)
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Bearer {access_token}",
-        }
         
         print(f"INFO:     Obtendo pdf do facematch em: {url}")
         
-        caminho_salvar_completo = os.path.join(caminho_salvar, f"facematch_pdf_{id}.pdf")
+        # PDF já baixado antes vem do armazenamento local, se ativado: por
+        # reflink ou hard link quando no mesmo sistema de arquivos
+        if retornarConteudo:
+            conteudo = None
+            if not forcarAtualizacao:
+                # O tamanho vem do índice: PDF armazenado acima do limite é
+                # recusado sem ser lido para a memória
+                _conferir_limite(await _deposito_laudos.tamanho(("obter_pdf", id)), PDF_EMBED_MAX_BYTES)
+                conteudo = await _deposito_laudos.ler(("obter_pdf", id))
+            if conteudo is not None:
+                print(f"INFO:     Pdf facematch do id {id} lido do armazenamento local")
+                return await _resultado_pdf_embutido(id, conteudo)
+        else:
+            caminho_salvar_completo = os.path.join(caminho_salvar, f"facematch_pdf_{id}.pdf")
+            modo = None
+            if not forcarAtualizacao:
+                modo = await _deposito_laudos.copiar_para(("obter_pdf", id), caminho_salvar_completo)
+            if modo is not None:
+                print(f"INFO:     Pdf facematch do id {id} copiado do armazenamento local ({modo})")
+                return {
+                    "status": "sucesso",
+                    "resultado": f"Pdf Facematch salvo em: {caminho_salvar_completo}"
+                }
 
-        # 2. Fazer a chamada GET para a API de Facematch
-        async with httpx.AsyncClient(verify=SSL_VERIFY) as client:
-            response = await client.get(url, headers=headers)
+        async def requisitar(headers: Dict[str, str]) -> httpx.Response:
+            # Chamada GET autenticada (token em cache) para a API de Facematch;
+            # sem compressão, para que os intervalos (Range) batam com o arquivo
+            response = await _requisicao_autenticada(
+                "GET", url, "obter_pdf", stream=True,
+                headers={"Accept-Encoding": "identity", **headers},
+            )
             print(f"INFO:     Resposta Facematch Status: {response.status_code}")
-            response.raise_for_status()
-            
-            with open(caminho_salvar_completo, "wb") as file:
-                file.write(response.content)
-                
-        
-        print(f"Facematch response status: {response.status_code}")
+            return response
+
+        # O PDF é lido em streaming e gravado direto no disco (ou, com
+        # retornarConteudo, em memória)
+        with _consulta_em_curso(("obter_pdf", id)):
+            response = await requisitar({})
+            try:
+                if response.is_error:
+                    await response.aread()
+                _registrar_nao_encontrado(("obter_pdf", id), response)
+                response.raise_for_status()
+                _cache_nao_encontrados.remover(("obter_pdf", id))
+
+                if retornarConteudo:
+                    conteudo = await _baixar_para_memoria(response, PDF_EMBED_MAX_BYTES, requisitar)
+                    tamanho = len(conteudo)
+                else:
+                    tamanho = await _baixar_para_arquivo(response, caminho_salvar_completo, requisitar)
+            finally:
+                await response.aclose()
+
+            print(f"Facematch response status: {response.status_code} ({tamanho} bytes)")
+            # Só um PDF de fato vai para o armazenamento local; uma mensagem
+            # como "Biometria em processamento" seria servida dali para sempre
+            if retornarConteudo:
+                inicio = conteudo[:5]
+            else:
+                inicio = await asyncio.to_thread(_ler_inicio, caminho_salvar_completo, 5)
+            armazenar = _resposta_pdf(response, inicio)
+            if not armazenar:
+                print(f"AVISO:    Resposta do pdf facematch do id {id} não é um PDF; não armazenada")
+            if retornarConteudo:
+                if armazenar and not _consulta_invalidada(("obter_pdf", id)):
+                    await _deposito_laudos.guardar_bytes(("obter_pdf", id), conteudo)
+                return await _resultado_pdf_embutido(id, conteudo)
+            if armazenar and not _consulta_invalidada(("obter_pdf", id)):
+                await _deposito_laudos.guardar_arquivo(("obter_pdf", id), caminho_salvar_completo)
         
         return {
             "status": "sucesso",
@@ -257,6 +2492,235 @@ async def obter_pdf_facematch(id: int, caminho_salvar: str) -> Dict[str, Any]:
         return {"status": "erro", "mensagem": f"Erro ao consultar facematch: {str(e)}"}
     
 
+async def _resultado_pdf_embutido(id: int, conteudo: bytes) -> Dict[str, Any]:
+    _conferir_limite(len(conteudo), PDF_EMBED_MAX_BYTES)
+    return {
+        "status": "sucesso",
+        "resultado": f"Pdf Facematch do ID {id} ({len(conteudo)} bytes) retornado como recurso embutido",
+        "pdf": await asyncio.to_thread(lambda: base64.b64encode(conteudo).decode("ascii")),
+    }
+
+
+def _resposta_pdf(response: httpx.Response, inicio: bytes) -> bool:
+    """
+    Indica se o download é um PDF: Content-Type application/pdf e conteúdo
+    começando com a assinatura %PDF-.
+    """
+    tipo = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+    return tipo == "application/pdf" and inicio.startswith(b"%PDF-")
+
+
+def _ler_inicio(caminho: str, tamanho: int) -> bytes:
+    with open(caminho, "rb") as arquivo:
+        return arquivo.read(tamanho)
+
+
+def _gravar_trecho(arquivo: io.BufferedIOBase, trecho: bytes) -> None:
+    arquivo.write(trecho)
+
+
+def _concluir_arquivo(arquivo: io.BufferedWriter) -> None:
+    arquivo.flush()
+    os.fsync(arquivo.fileno())
+    arquivo.close()
+
+
+def _reiniciar_arquivo(arquivo: io.BufferedIOBase) -> None:
+    arquivo.seek(0)
+    arquivo.truncate()
+
+
+def _descartar_arquivo(arquivo: io.BufferedWriter) -> None:
+    arquivo.close()
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(arquivo.name)
+
+
+def _validador_download(response: httpx.Response) -> Optional[str]:
+    """
+    Validador para o If-Range de uma retomada: o ETag forte ou, na falta
+    dele, o Last-Modified. None quando a resposta não permite retomar por
+    intervalo (sem Accept-Ranges: bytes, comprimida ou sem validador).
+    """
+    if "bytes" not in response.headers.get("Accept-Ranges", "").lower():
+        return None
+    if response.headers.get("Content-Encoding", "identity").lower() != "identity":
+        return None
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+
+def _tamanho_declarado(response: httpx.Response) -> Optional[int]:
+    valor = response.headers.get("Content-Length")
+    return int(valor) if valor is not None and valor.isdigit() else None
+
+
+def _retomada_confere(
+    response: httpx.Response, inicio: int, total: Optional[int], validador: str
+) -> bool:
+    """
+    Confere se a resposta 206 continua o mesmo PDF exatamente do byte
+    `inicio` até o fim.
+    """
+    intervalo = re.fullmatch(
+        r"bytes (\d+)-(\d+)/(\d+)", response.headers.get("Content-Range", "").strip()
+    )
+    if intervalo is None:
+        return False
+    primeiro, ultimo, tamanho = (int(g) for g in intervalo.groups())
+    if primeiro != inicio or ultimo != tamanho - 1:
+        return False
+    if total is not None and tamanho != total:
+        return False
+    cabecalho = "ETag" if validador.startswith('"') else "Last-Modified"
+    return response.headers.get(cabecalho, validador) == validador
+
+
+def _falta_no_download(
+    response: httpx.Response, recebidos: int, gravados: int, total: Optional[int]
+) -> Optional[str]:
+    """
+    Descreve o que faltou no corpo recebido; None se ele veio completo.
+    `recebidos` é o que foi gravado a partir desta resposta: sem compressão
+    (Accept-Encoding: identity), deve bater com o Content-Length.
+    """
+    esperado = _tamanho_declarado(response)
+    sem_compressao = response.headers.get("Content-Encoding", "identity").lower() == "identity"
+    if esperado is not None and sem_compressao and recebidos != esperado:
+        return f"recebidos {recebidos} de {esperado} bytes"
+    if total is not None and gravados != total:
+        return f"gravados {gravados} de {total} bytes"
+    return None
+
+
+async def _baixar_para_arquivo(
+    response: httpx.Response,
+    destino: str,
+    requisitar: Optional[Callable[[Dict[str, str]], Awaitable[httpx.Response]]] = None,
+) -> int:
+    """
+    Grava o corpo da resposta em `destino` sem mantê-lo em memória: os
+    trechos vão, em uma thread, para um arquivo temporário no mesmo
+    diretório, que só é renomeado para o nome final (os.replace, atômico)
+    depois de conferido o tamanho. Em qualquer falha, inclusive
+    cancelamento, o temporário é apagado e o destino fica como estava.
+    Devolve o tamanho gravado.
+    """
+    diretorio, nome = os.path.split(os.path.abspath(destino))
+    temporario = os.path.join(diretorio, f".{nome}.{os.urandom(4).hex()}.parcial")
+    arquivo = await asyncio.to_thread(open, temporario, "xb")
+    try:
+        gravados = await _baixar_corpo(response, arquivo, requisitar)
+        await asyncio.to_thread(_concluir_arquivo, arquivo)
+        await asyncio.to_thread(os.replace, temporario, destino)
+    except BaseException:
+        # Síncrono: precisa acontecer mesmo se a tarefa estiver sendo cancelada
+        _descartar_arquivo(arquivo)
+        raise
+    return gravados
+
+
+async def _baixar_para_memoria(
+    response: httpx.Response,
+    limite: int,
+    requisitar: Optional[Callable[[Dict[str, str]], Awaitable[httpx.Response]]] = None,
+) -> bytes:
+    """
+    Lê o corpo da resposta em memória, sem passar pelo disco, recusando-o
+    assim que passar de `limite` bytes (pelo Content-Length ou durante a
+    leitura).
+    """
+    buffer = io.BytesIO()
+    await _baixar_corpo(response, buffer, requisitar, limite)
+    return buffer.getvalue()
+
+
+def _conferir_limite(tamanho: Optional[int], limite: Optional[int]) -> None:
+    if tamanho is not None and limite is not None and tamanho > limite:
+        raise ValueError(
+            f"PDF maior que o limite de {limite} bytes para retorno do conteúdo "
+            "(ACERTPIX_PDF_EMBED_MAX_BYTES); informe caminho_salvar"
+        )
+
+
+async def _baixar_corpo(
+    response: httpx.Response,
+    arquivo: io.BufferedIOBase,
+    requisitar: Optional[Callable[[Dict[str, str]], Awaitable[httpx.Response]]] = None,
+    limite: Optional[int] = None,
+) -> int:
+    """
+    Escreve o corpo da resposta em `arquivo`, trecho a trecho e em uma
+    thread, e devolve o tamanho escrito.
+
+    Se a conexão cair no meio, `requisitar(headers)` refaz a requisição
+    (até DOWNLOAD_MAX_RESUMES vezes): com Range a partir do último byte
+    gravado e If-Range com o ETag/Last-Modified da primeira resposta, quando
+    a API anuncia Accept-Ranges; se ela não aceitar intervalos, responder o
+    PDF inteiro (200) ou o PDF tiver mudado, o download recomeça do zero.
+    """
+    atual = response
+    validador = _validador_download(response)
+    total = _tamanho_declarado(response) if validador else None
+    _conferir_limite(_tamanho_declarado(response), limite)
+    gravados = 0
+    retomadas = 0
+    try:
+        while True:
+            inicio = gravados
+            try:
+                async for trecho in atual.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    _conferir_limite(gravados + len(trecho), limite)
+                    await asyncio.to_thread(_gravar_trecho, arquivo, trecho)
+                    gravados += len(trecho)
+                falta = _falta_no_download(atual, gravados - inicio, gravados, total)
+            except httpx.TransportError as e:
+                falta = str(e) or type(e).__name__
+            if falta is None:
+                return gravados
+            if requisitar is None or retomadas >= DOWNLOAD_MAX_RESUMES:
+                raise OSError(f"Download incompleto: {falta}")
+
+            retomadas += 1
+            if atual is not response:
+                await atual.aclose()
+            atual = response
+            espera = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (retomadas - 1))
+            await asyncio.sleep(random.uniform(0, espera))
+
+            if validador and gravados:
+                print(
+                    f"AVISO:    Download de {response.url} interrompido ({falta}); "
+                    f"retomando do byte {gravados} ({retomadas}/{DOWNLOAD_MAX_RESUMES})"
+                )
+                atual = await requisitar({"Range": f"bytes={gravados}-", "If-Range": validador})
+                if atual.status_code == 206 and _retomada_confere(atual, gravados, total, validador):
+                    continue
+                if atual.status_code != 200:
+                    await atual.aclose()
+                    atual = response
+            else:
+                print(
+                    f"AVISO:    Download de {response.url} interrompido ({falta}); "
+                    f"baixando novamente do início ({retomadas}/{DOWNLOAD_MAX_RESUMES})"
+                )
+
+            # Sem retomada possível (ou a API devolveu o PDF inteiro): recomeça
+            if atual is response:
+                atual = await requisitar({})
+            atual.raise_for_status()
+            _conferir_limite(_tamanho_declarado(atual), limite)
+            await asyncio.to_thread(_reiniciar_arquivo, arquivo)
+            gravados = 0
+            validador = _validador_download(atual)
+            total = _tamanho_declarado(atual) if validador else None
+    finally:
+        if atual is not response:
+            await atual.aclose()
+
+
 @server.call_tool()
 async def handle_call_tool(
     name: str, arguments: dict | None
@@ -264,6 +2728,14 @@ async def handle_call_tool(
     """
     Manipula as chamadas às ferramentas disponíveis.
     """
+    if name == "diagnostico-facematch":
+        return [
+            types.TextContent(
+                type="text",
+                text=json.dumps(diagnostico_servidor(), indent=2, ensure_ascii=False),
+            )
+        ]
+
     if not arguments:
         raise ValueError("Argumentos ausentes")
 
@@ -275,7 +2747,9 @@ async def handle_call_tool(
                 raise ValueError("ID é obrigatório")
 
             try:
-                resultado = await consultar_facematch(id_biometria)
+                resultado = await consultar_facematch(
+                    id_biometria, bool(arguments.get("forcarAtualizacao"))
+                )
                 return [
                     types.TextContent(
                         type="text",
@@ -296,6 +2770,7 @@ async def handle_call_tool(
                 caminhoImagemFrente = arguments.get("caminhoImagemFrente")
                 caminhoImagemVerso = arguments.get("caminhoImagemVerso", "")
                 caminhoImagemSelfie = arguments.get("caminhoImagemSelfie")
+                chaveIdempotencia = arguments.get("chaveIdempotencia")
                 
                 if not all([chave]):
                     raise ValueError("Chave é obrigatória")
@@ -306,20 +2781,8 @@ async def handle_call_tool(
                 if not all([caminhoImagemSelfie]):
                     raise ValueError("ImagemSelfie é obrigatória")
                 
-                base64ImagemFrente = ""
-                if(caminhoImagemFrente):
-                    base64ImagemFrente = converter_para_base64(caminhoImagemFrente)
-
-                base64ImagemVerso = ""
-                if(caminhoImagemVerso):
-                    base64ImagemVerso = converter_para_base64(caminhoImagemVerso)
-
-                base64ImagemSelfie = ""
-                if(caminhoImagemSelfie):
-                    base64ImagemSelfie = converter_para_base64(caminhoImagemSelfie)
-
                 try:
-                    resultado = await enviar_facematch(chave, cpf, base64ImagemFrente, base64ImagemVerso, base64ImagemSelfie)
+                    resultado = await enviar_facematch(chave, cpf, caminhoImagemFrente, caminhoImagemVerso, caminhoImagemSelfie, chaveIdempotencia)
                     return [
                         types.TextContent(
                             type="text",
@@ -340,21 +2803,39 @@ async def handle_call_tool(
             id_biometria = arguments.get("id")
             
             caminho_salvar = arguments.get("caminho_salvar")
+            retornar_conteudo = bool(arguments.get("retornarConteudo"))
 
             if id_biometria is None:
                 raise ValueError("ID é obrigatório")
             
-            if caminho_salvar is None:
+            if caminho_salvar is None and not retornar_conteudo:
                 raise ValueError("CaminhoSalvar é obrigatório")
                 
             try:
-                resultado = await obter_pdf_facematch(id_biometria, caminho_salvar)
-                return [
+                resultado = await obter_pdf_facematch(
+                    id_biometria, caminho_salvar, bool(arguments.get("forcarAtualizacao")),
+                    retornar_conteudo,
+                )
+                # O PDF vai como recurso embutido (blob), fora do texto
+                pdf = resultado.pop("pdf", None)
+                conteudo = [
                     types.TextContent(
                         type="text",
                         text=f"Resultado do obter pdf de facematch para ID {id_biometria}:\n{json.dumps(resultado, indent=2, ensure_ascii=False)}"
                     )
                 ]
+                if pdf is not None:
+                    conteudo.append(
+                        types.EmbeddedResource(
+                            type="resource",
+                            resource=types.BlobResourceContents(
+                                uri=f"acertpix://facematch/pdf/{id_biometria}",
+                                mimeType="application/pdf",
+                                blob=pdf,
+                            ),
+                        )
+                    )
+                return conteudo
             except Exception as e:
                 return [
                     types.TextContent(
@@ -370,19 +2851,25 @@ async def main():
     """
     Inicia o servidor MCP.
     """
-    async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
-        await server.run(
-            read_stream,
-            write_stream,
-            InitializationOptions(
-                server_name="acertpix-api-facematch",
-                server_version="0.1.0",
-                capabilities=server.get_capabilities(
-                    notification_options=NotificationOptions(),
-                    experimental_capabilities={},
+    # Cliente HTTP único, reaproveitado por todas as chamadas até o encerramento
+    obter_http_client()
+    try:
+        async with mcp.server.stdio.stdio_server() as (read_stream, write_stream):
+            await server.run(
+                read_stream,
+                write_stream,
+                InitializationOptions(
+                    server_name="acertpix-api-facematch",
+                    server_version="0.1.0",
+                    capabilities=server.get_capabilities(
+                        notification_options=NotificationOptions(),
+                        experimental_capabilities={},
+                    ),
                 ),
-            ),
-        )
+            )
+    finally:
+        await fechar_http_client()
+        fechar_executor_imagens()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+Benchmark HTTP/1.1 x HTTP/2 do cliente compartilhado dos servidores MCP.
+
+Sobe um servidor local (hypercorn com TLS autoassinado) que imita a API da
+Acertpix e executa, com o código real do acertpix-api-lite, rajadas de
+envios (corpo base64 grande) e consultas concorrentes em três cenários:
+
+    http1        ACERTPIX_HTTP2 desligado
+    http2        ACERTPIX_HTTP2 ligado, servidor oferece h2 via ALPN
+    http2->1.1   ACERTPIX_HTTP2 ligado, servidor só oferece http/1.1 (fallback)
+
+Requisitos: pip install "httpx[http2]" hypercorn e o comando openssl.
+
+Uso:
+    python benchmarks/http2_vs_http1.py [--envios 50] [--consultas 200] [--kb 512]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(RAIZ, "acertpix-api-lite", "src"))
+
+
+# ---- Servidor local (stand-in da API) ----
+
+_conexoes = set()
+
+
+async def app(scope, receive, send):
+    """
+    Aplicação ASGI mínima com os endpoints usados pelo servidor lite.
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            mensagem = await receive()
+            if mensagem["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif mensagem["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    _conexoes.add(tuple(scope.get("client") or ()))
+
+    corpo = b""
+    while True:
+        mensagem = await receive()
+        corpo += mensagem.get("body", b"")
+        if not mensagem.get("more_body"):
+            break
+
+    caminho = scope["path"]
+    if caminho.endswith("/OAuth2/Token"):
+        resposta = {"access_token": "token-benchmark", "expires_in": 3600}
+    elif caminho.endswith("/Conexoes"):
+        resposta = {"conexoes": len(_conexoes)}
+        _conexoes.clear()
+    else:
+        # Simula o tempo de processamento da API
+        await asyncio.sleep(0.005)
+        resposta = {"caminho": caminho, "bytes": len(corpo)}
+
+    dados = json.dumps(resposta).encode("utf-8")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(dados)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": dados})
+
+
+def _executar_servidor(porta: int, certificado: str, chave: str, alpn: str) -> None:
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{porta}"]
+    config.certfile = certificado
+    config.keyfile = chave
+    config.alpn_protocols = alpn.split(",")
+    config.loglevel = "WARNING"
+    asyncio.run(serve(app, config))
+
+
+def _porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _gerar_certificado(diretorio: str) -> tuple:
+    certificado = os.path.join(diretorio, "cert.pem")
+    chave = os.path.join(diretorio, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", chave, "-out", certificado, "-days", "1",
+            "-subj", "/CN=127.0.0.1",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certificado, chave
+
+
+def _iniciar_servidor(certificado: str, chave: str, alpn: str) -> tuple:
+    porta = _porta_livre()
+    processo = subprocess.Popen(
+        [sys.executable, __file__, "--servidor", str(porta), certificado, chave, alpn]
+    )
+    limite = time.time() + 10
+    while time.time() < limite:
+        try:
+            socket.create_connection(("127.0.0.1", porta), timeout=0.2).close()
+            return processo, porta
+        except OSError:
+            time.sleep(0.1)
+    processo.kill()
+    raise RuntimeError("Servidor local não iniciou")
+
+
+# ---- Cliente (código real do servidor MCP) ----
+
+
+async def _cenario(server, url: str, http2: bool, envios: int, consultas: int, imagem: str) -> dict:
+    server.API_BASE_URL = url
+    server.SSL_VERIFY = False
+    server.HTTP2 = http2
+    await server.fechar_http_client()
+    server._token_cache.update({"access_token": None, "expira_em": 0.0})
+
+    latencias = []
+
+    async def medir(coro):
+        inicio = time.perf_counter()
+        resultado = await coro
+        latencias.append(time.perf_counter() - inicio)
+        if resultado.get("status") != "sucesso":
+            raise RuntimeError(resultado)
+
+    # Aquecimento: token e primeira conexão fora da medição
+    await server.obter_access_token()
+
+    inicio = time.perf_counter()
+    tarefas = [
+        medir(server.enviar_lite(f"chave-{i}", imagem, imagem, "", "", ""))
+        for i in range(envios)
+    ]
+    tarefas += [medir(server.consultar_lite(f"chave-{i}")) for i in range(consultas)]
+    await asyncio.gather(*tarefas)
+    total = time.perf_counter() - inicio
+
+    resposta = await server.obter_http_client().get(f"{url}/Conexoes")
+    versao = resposta.http_version
+    conexoes = resposta.json()["conexoes"]
+    await server.fechar_http_client()
+
+    latencias.sort()
+    return {
+        "protocolo": versao,
+        "total_s": total,
+        "p50_ms": statistics.median(latencias) * 1000,
+        "p95_ms": latencias[int(len(latencias) * 0.95) - 1] * 1000,
+        "conexoes": conexoes,
+    }
+
+
+async def _executar(args) -> None:
+    import contextlib
+    import io
+
+    # Sem o cache de consultas, os cenários seguintes ao primeiro respondem as
+    # consultas da memória e não medem o transporte
+    os.environ.setdefault("ACERTPIX_RESPONSE_CACHE_MAX_BYTES", "0")
+    # Os servidores registram cada chamada em stdout; silencia durante a medição
+    with contextlib.redirect_stdout(io.StringIO()):
+        from acertpix_api_lite import server
+
+    with tempfile.TemporaryDirectory() as diretorio:
+        certificado, chave = _gerar_certificado(diretorio)
+        # Cabeçalho JPEG (SOI + APP0/JFIF) para passar na checagem de assinatura
+        # do servidor; o resto é preenchimento aleatório do tamanho pedido
+        imagem = os.path.join(diretorio, "imagem.jpg")
+        cabecalho = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+        with open(imagem, "wb") as arquivo:
+            arquivo.write(cabecalho + os.urandom(max(args.kb * 1024 - len(cabecalho), 0)))
+        cenarios = [
+            ("http1", "h2,http/1.1", False),
+            ("http2", "h2,http/1.1", True),
+            ("http2->1.1", "http/1.1", True),
+        ]
+        print(
+            f"{args.envios} envios de {2 * args.kb} KB + {args.consultas} consultas concorrentes\n"
+        )
+        print(f"{'cenário':<12} {'protocolo':<10} {'total (s)':>10} {'p50 (ms)':>10} {'p95 (ms)':>10} {'conexões':>9}")
+        for nome, alpn, http2 in cenarios:
+            processo, porta = _iniciar_servidor(certificado, chave, alpn)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    r = await _cenario(
+                        server, f"https://127.0.0.1:{porta}", http2,
+                        args.envios, args.consultas, imagem,
+                    )
+                print(
+                    f"{nome:<12} {r['protocolo']:<10} {r['total_s']:>10.3f} "
+                    f"{r['p50_ms']:>10.1f} {r['p95_ms']:>10.1f} {r['conexoes']:>9}"
+                )
+            finally:
+                processo.terminate()
+                processo.wait()
+
+
+def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] == "--servidor":
+        porta, certificado, chave, alpn = sys.argv[2:6]
+        _executar_servidor(int(porta), certificado, chave, alpn)
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--envios", type=int, default=50)
+    parser.add_argument("--consultas", type=int, default=200)
+    parser.add_argument("--kb", type=int, default=512, help="tamanho de cada imagem em KB")
+    asyncio.run(_executar(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
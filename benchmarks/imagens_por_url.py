@@ -0,0 +1,301 @@
+"""
+Verificação do envio de imagens informadas por URL http(s) (enviar-lite).
+
+Sobe dois servidores locais (http.server, sem TLS): um que imita a API da
+Acertpix e confere o corpo recebido, e outro que serve as imagens. Executa,
+com o código real do acertpix-api-lite, os cenários:
+
+    grande            HEAD com Content-Length: início conferido antes do envio
+                      (GET com Range) e download repassado em streaming para o
+                      corpo, sem a imagem inteira em memória
+    redirecionamento  URL que redireciona (302) para a imagem
+    sem-tamanho       HEAD sem Content-Length (chunked): baixada para a memória
+    nova-tentativa    API responde 503 uma vez; com chave de idempotência o
+                      envio é repetido e a imagem baixada de novo
+    muito-grande      Content-Length acima de ACERTPIX_IMAGE_URL_MAX_BYTES: erro
+                      sem chamar a API
+    inexistente       404 na URL da imagem: erro sem chamar a API
+    alterada          GET com tamanho diferente do Content-Length do HEAD: erro
+                      sem chamar a API
+    nao-imagem        conteúdo sem assinatura de imagem: erro sem chamar a API
+
+Cada cenário confere o SHA-256 do corpo recebido pela API com o JSON
+esperado, as requisições feitas ao servidor de imagens (sem o token da API)
+e, no cenário grande, o pico de memória; sai com código 1 se algum falhar.
+
+Uso:
+    python benchmarks/imagens_por_url.py [--mb 16]
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(RAIZ, "acertpix-api-lite", "src"))
+
+CPF = "52998224725"
+CABECALHO_JPEG = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+
+
+def _nova_imagem(tamanho: int) -> bytes:
+    return CABECALHO_JPEG + os.urandom(max(tamanho - len(CABECALHO_JPEG), 0))
+
+
+# ---- Servidores locais (stand-in da API e das imagens) ----
+
+# Imagens servidas por caminho, requisições recebidas pelo servidor de
+# imagens e envios (tamanho e SHA-256 do corpo) recebidos pela API
+_estado = {"imagens": {}, "limite": 0, "requisicoes": [], "envios": [], "falhar": 0}
+
+
+class _HandlerApi(BaseHTTPRequestHandler):
+    """
+    Token OAuth2 e endpoint de envio; o corpo é lido em blocos (com
+    Content-Length ou chunked) e guardado só como tamanho e SHA-256.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _responder(self, status: int, dados: dict) -> None:
+        corpo = json.dumps(dados).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _ler_corpo(self) -> tuple:
+        resumo = hashlib.sha256()
+        tamanho = 0
+
+        def ler(quantidade: int) -> None:
+            nonlocal tamanho
+            while quantidade:
+                trecho = self.rfile.read(min(quantidade, 65536))
+                if not trecho:
+                    return
+                resumo.update(trecho)
+                tamanho += len(trecho)
+                quantidade -= len(trecho)
+
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                quantidade = int(self.rfile.readline().split(b";")[0], 16)
+                if not quantidade:
+                    self.rfile.readline()
+                    break
+                ler(quantidade)
+                self.rfile.readline()
+        else:
+            ler(int(self.headers.get("Content-Length") or 0))
+        return tamanho, resumo.hexdigest()
+
+    def do_POST(self) -> None:
+        corpo = self._ler_corpo()
+        if self.path.endswith("/OAuth2/Token"):
+            return self._responder(200, {"access_token": "token-stand-in", "expires_in": 3600})
+        _estado["envios"].append(corpo)
+        if _estado["falhar"]:
+            _estado["falhar"] -= 1
+            return self._responder(503, {})
+        self._responder(200, {"id": len(_estado["envios"])})
+
+
+class _HandlerImagens(BaseHTTPRequestHandler):
+    """
+    Imagens de cada cenário: /redir redireciona para /grande, /sem-tamanho
+    vem chunked (e ignora Range), /muito-grande anuncia mais que o limite e
+    /alterada anuncia no HEAD menos bytes do que tem. GET com Range recebe
+    206 com o intervalo pedido.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _cabecalhos(self) -> bytes:
+        _estado["requisicoes"].append((self.command, self.path, self.headers.get("Authorization")))
+        if self.path == "/redir":
+            self.send_response(302)
+            self.send_header("Location", "/grande")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return b""
+        dados = _estado["imagens"].get(self.path)
+        if dados is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return b""
+        intervalo = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if self.command == "GET" and intervalo and self.path != "/sem-tamanho":
+            inicio, fim = int(intervalo.group(1)), int(intervalo.group(2))
+            self.send_response(206)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Range", f"bytes {inicio}-{fim}/{len(dados)}")
+            self.send_header("Content-Length", str(len(dados[inicio:fim + 1])))
+            self.end_headers()
+            return dados[inicio:fim + 1]
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        if self.path == "/sem-tamanho":
+            self.send_header("Transfer-Encoding", "chunked")
+        elif self.path == "/muito-grande":
+            self.send_header("Content-Length", str(_estado["limite"] + 1))
+        elif self.path == "/alterada" and self.command == "HEAD":
+            self.send_header("Content-Length", str(len(dados) - 10))
+        else:
+            self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+        return dados
+
+    def do_HEAD(self) -> None:
+        self._cabecalhos()
+
+    def do_GET(self) -> None:
+        dados = self._cabecalhos()
+        if self.path == "/sem-tamanho":
+            for inicio in range(0, len(dados), 7000):
+                trecho = dados[inicio:inicio + 7000]
+                self.wfile.write(b"%x\r\n" % len(trecho) + trecho + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        if self.path == "/alterada":
+            self.close_connection = True
+        with contextlib.suppress(OSError):
+            for inicio in range(0, len(dados), 65536):
+                self.wfile.write(dados[inicio:inicio + 65536])
+
+
+def _iniciar_servidor(handler) -> ThreadingHTTPServer:
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+# ---- Cliente (código real do servidor MCP) ----
+
+
+def _corpo_esperado(frente: bytes, selfie: bytes) -> tuple:
+    dados = json.dumps(
+        {
+            "Chave": "chave-url",
+            "ImagemFrente": base64.b64encode(frente).decode(),
+            "ImagemVerso": "",
+            "ImagemSelfie": base64.b64encode(selfie).decode(),
+            "ImagemQrCode": "",
+            "CPF": CPF,
+        }
+    ).encode()
+    return len(dados), hashlib.sha256(dados).hexdigest()
+
+
+async def _cenario(server, urls: str, frente: str, selfie: str, falhar: int = 0) -> dict:
+    _estado.update(requisicoes=[], envios=[], falhar=falhar)
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            resultado = await server.enviar_lite(
+                "chave-url", f"{urls}{frente}", "", f"{urls}{selfie}", "", CPF, "idem-url"
+            )
+        pico = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "status": resultado["status"],
+        "envios": _estado["envios"],
+        "gets": sum(1 for metodo, _, _ in _estado["requisicoes"] if metodo == "GET"),
+        "sem_token": not any(token for _, _, token in _estado["requisicoes"]),
+        "pico": pico,
+    }
+
+
+async def _executar(args) -> bool:
+    with contextlib.redirect_stdout(io.StringIO()):
+        from acertpix_api_lite import server
+
+    tamanho = args.mb * 2**20
+    grande = _nova_imagem(tamanho)
+    pequena = _nova_imagem(64 * 1024)
+    _estado["imagens"] = {
+        "/grande": grande,
+        "/pequena": pequena,
+        "/sem-tamanho": pequena,
+        "/muito-grande": pequena,
+        "/alterada": pequena,
+        "/nao-imagem": os.urandom(64 * 1024),
+    }
+
+    api = _iniciar_servidor(_HandlerApi)
+    imagens = _iniciar_servidor(_HandlerImagens)
+    urls = f"http://127.0.0.1:{imagens.server_address[1]}"
+    server.API_BASE_URL = f"http://127.0.0.1:{api.server_address[1]}"
+    server.RETRY_BACKOFF_BASE = 0.01
+    server.IMAGE_URL_MAX_BYTES = max(server.IMAGE_URL_MAX_BYTES, 2 * tamanho)
+    _estado["limite"] = server.IMAGE_URL_MAX_BYTES
+
+    def enviou(*esperados):
+        return lambda r: r["status"] == "sucesso" and r["envios"] == list(esperados) and r["sem_token"]
+
+    def recusou(r: dict) -> bool:
+        return r["status"] == "erro" and not r["envios"]
+
+    com_grande = _corpo_esperado(grande, pequena)
+    com_pequenas = _corpo_esperado(pequena, pequena)
+    cenarios = [
+        ("grande", "/grande", "/pequena", 0,
+         lambda r: enviou(com_grande)(r) and r["pico"] < tamanho // 2),
+        ("redirecionamento", "/redir", "/pequena", 0, enviou(com_grande)),
+        ("sem-tamanho", "/sem-tamanho", "/pequena", 0, enviou(com_pequenas)),
+        # Dois GETs com Range no planejamento e dois downloads por tentativa
+        ("nova-tentativa", "/pequena", "/pequena", 1,
+         lambda r: enviou(com_pequenas, com_pequenas)(r) and r["gets"] == 6),
+        ("muito-grande", "/muito-grande", "/pequena", 0, lambda r: recusou(r) and not r["gets"]),
+        ("inexistente", "/nada", "/pequena", 0, recusou),
+        ("alterada", "/alterada", "/pequena", 0, recusou),
+        ("nao-imagem", "/nao-imagem", "/pequena", 0, recusou),
+    ]
+
+    print(f"Imagem grande de {args.mb} MB, limite de {server.IMAGE_URL_MAX_BYTES // 2**20} MB por URL\n")
+    print(f"{'cenário':<18} {'resultado':<10} {'envios':>7} {'GETs':>5} {'pico (MB)':>10}  verificação")
+    sucesso = True
+    with contextlib.redirect_stdout(io.StringIO()):
+        await server.obter_access_token()
+    for nome, frente, selfie, falhar, confere in cenarios:
+        r = await _cenario(server, urls, frente, selfie, falhar)
+        ok = confere(r)
+        sucesso = sucesso and ok
+        print(
+            f"{nome:<18} {r['status']:<10} {len(r['envios']):>7} {r['gets']:>5} "
+            f"{r['pico'] / 2**20:>10.2f}  {'ok' if ok else 'FALHOU'}"
+        )
+    await server.fechar_http_client()
+    api.shutdown()
+    imagens.shutdown()
+    return sucesso
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mb", type=int, default=16, help="tamanho da imagem grande em MB")
+    if not asyncio.run(_executar(parser.parse_args())):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Verificação da retomada de downloads do PDF do facematch (obter-pdf-facematch).
+
+Sobe um servidor local (http.server, sem TLS) que imita a API da Acertpix e
+derruba a conexão no meio do PDF, e executa, com o código real do
+acertpix-api-facematch, os cenários:
+
+    etag              retoma com Range + If-Range pelo ETag (só o que falta)
+    last-modified     retoma com If-Range pelo Last-Modified
+    sem-range         API sem Accept-Ranges: baixa de novo do início
+    pdf-mudou         If-Range não confere, a API devolve o PDF novo inteiro (200)
+    206-errado        206 com Content-Range que não continua o arquivo: descarta
+                      e baixa de novo do início
+    duas-quedas       duas quedas seguidas, retomadas encadeadas
+    sempre-cai        quedas além de ACERTPIX_DOWNLOAD_MAX_RESUMES: erro, sem
+                      arquivo final nem temporário
+    memoria           retornarConteudo: retomada com o PDF em memória
+
+Cada cenário confere o arquivo (ou o base64) byte a byte com o PDF servido,
+as requisições recebidas e o total de bytes transferidos; sai com código 1
+se algum falhar.
+
+Uso:
+    python benchmarks/retomada_pdf_facematch.py [--mb 8]
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(RAIZ, "acertpix-api-facematch", "src"))
+
+LAST_MODIFIED = "Wed, 21 Oct 2015 07:28:00 GMT"
+
+
+# ---- Servidor local (stand-in da API) ----
+
+# Estado do cenário atual: modo, PDF servido, cortes pendentes (bytes
+# escritos antes de derrubar cada conexão) e requisições recebidas
+_estado = {"modo": "etag", "pdf": b"", "etag": '"v1"', "cortes": [], "requisicoes": [], "enviados": 0}
+
+
+def _novo_pdf(tamanho: int) -> bytes:
+    return b"%PDF-1.4\n" + os.urandom(max(tamanho - 9, 0))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Endpoints usados pela ferramenta obter-pdf-facematch: token OAuth2 e
+    /Biometria/ObterPdf/{id}, com Range/If-Range conforme o modo.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        dados = json.dumps({"access_token": "token-stand-in", "expires_in": 3600}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def do_GET(self) -> None:
+        modo = _estado["modo"]
+        pdf = _estado["pdf"]
+        intervalo = self.headers.get("Range")
+        _estado["requisicoes"].append((intervalo, self.headers.get("If-Range")))
+
+        inicio = 0
+        if intervalo and modo != "sem-range":
+            validador = LAST_MODIFIED if modo == "last-modified" else _estado["etag"]
+            if self.headers.get("If-Range") == validador:
+                inicio = int(re.match(r"bytes=(\d+)-", intervalo).group(1))
+        corpo = pdf[inicio:]
+
+        self.send_response(206 if inicio else 200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(corpo)))
+        if modo != "sem-range":
+            self.send_header("Accept-Ranges", "bytes")
+            if modo == "last-modified":
+                self.send_header("Last-Modified", LAST_MODIFIED)
+            else:
+                self.send_header("ETag", _estado["etag"])
+        if inicio:
+            # 206-errado: o intervalo anunciado começa um byte depois do pedido
+            primeiro = inicio + (1 if modo == "206-errado" else 0)
+            self.send_header("Content-Range", f"bytes {primeiro}-{len(pdf) - 1}/{len(pdf)}")
+        self.end_headers()
+
+        corte = _estado["cortes"].pop(0) if _estado["cortes"] else None
+        quantidade = len(corpo) if corte is None else min(corte, len(corpo))
+        with contextlib.suppress(OSError):
+            self.wfile.write(corpo[:quantidade])
+            _estado["enviados"] += quantidade
+        if corte is not None:
+            self.close_connection = True
+            if modo == "pdf-mudou":
+                _estado["pdf"] = _novo_pdf(len(pdf) // 2)
+                _estado["etag"] = '"v2"'
+
+
+def _iniciar_servidor() -> ThreadingHTTPServer:
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+
+# ---- Cliente (código real do servidor MCP) ----
+
+
+async def _cenario(server, diretorio: str, id: int, modo: str, cortes: list, tamanho: int, memoria: bool = False) -> dict:
+    _estado.update(
+        modo=modo, pdf=_novo_pdf(tamanho), etag='"v1"', cortes=list(cortes), requisicoes=[], enviados=0
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        resultado = await server.obter_pdf_facematch(id, diretorio, True, memoria)
+
+    destino = os.path.join(diretorio, f"facematch_pdf_{id}.pdf")
+    if memoria:
+        recebido = base64.b64decode(resultado["pdf"]) if "pdf" in resultado else None
+    else:
+        recebido = open(destino, "rb").read() if os.path.exists(destino) else None
+    return {
+        "status": resultado["status"],
+        "igual": recebido == _estado["pdf"],
+        "requisicoes": _estado["requisicoes"],
+        "enviados": _estado["enviados"],
+        "temporarios": [nome for nome in os.listdir(diretorio) if nome.endswith(".parcial")],
+        "existe": os.path.exists(destino),
+    }
+
+
+async def _executar(args) -> bool:
+    with contextlib.redirect_stdout(io.StringIO()):
+        from acertpix_api_facematch import server
+
+    servidor = _iniciar_servidor()
+    server.API_BASE_URL = f"http://127.0.0.1:{servidor.server_address[1]}"
+    server.RETRY_BACKOFF_BASE = 0.01
+    server.PDF_EMBED_MAX_BYTES = max(server.PDF_EMBED_MAX_BYTES, 2 * args.mb * 2**20)
+    tamanho = args.mb * 2**20
+    corte = tamanho // 3
+    maximo = server.DOWNLOAD_MAX_RESUMES
+
+    def retomou(r: dict, pedidos: int) -> bool:
+        # Cada GET depois do primeiro pede Range a partir do que já foi gravado
+        # (o último trecho incompleto se perde, então volta um pouco antes do
+        # corte) e, no total, trafega menos que um novo download completo
+        return (
+            len(r["requisicoes"]) == pedidos
+            and all(
+                intervalo and validador and intervalo != "bytes=0-"
+                for intervalo, validador in r["requisicoes"][1:]
+            )
+            and r["enviados"] < corte + len(_estado["pdf"])
+        )
+
+    cenarios = [
+        ("etag", "etag", [corte], False,
+         lambda r: r["igual"] and retomou(r, 2)),
+        ("last-modified", "last-modified", [corte], False,
+         lambda r: r["igual"] and retomou(r, 2) and r["requisicoes"][1][1] == LAST_MODIFIED),
+        ("sem-range", "sem-range", [corte], False,
+         lambda r: r["igual"] and r["requisicoes"] == [(None, None)] * 2
+         and r["enviados"] == corte + tamanho),
+        ("pdf-mudou", "pdf-mudou", [corte], False,
+         lambda r: r["igual"] and len(r["requisicoes"]) == 2 and r["requisicoes"][1][1] == '"v1"'
+         and r["enviados"] == corte + len(_estado["pdf"])),
+        ("206-errado", "206-errado", [corte], False,
+         lambda r: r["igual"] and len(r["requisicoes"]) == 3 and r["requisicoes"][2] == (None, None)),
+        ("duas-quedas", "etag", [corte, corte], False,
+         lambda r: r["igual"] and retomou(r, 3)),
+        ("sempre-cai", "etag", [corte // 4] * (maximo + 2), False,
+         lambda r: r["status"] == "erro" and len(r["requisicoes"]) == maximo + 1
+         and not r["existe"] and not r["temporarios"]),
+        ("memoria", "etag", [corte], True,
+         lambda r: r["igual"] and retomou(r, 2)),
+    ]
+
+    print(f"PDF de {args.mb} MB, queda após {corte // 1024} KB, até {maximo} retomadas\n")
+    print(f"{'cenário':<15} {'resultado':<10} {'GETs':>5} {'MB enviados':>12}  verificação")
+    sucesso = True
+    with tempfile.TemporaryDirectory() as diretorio:
+        with contextlib.redirect_stdout(io.StringIO()):
+            await server.obter_access_token()
+        for id, (nome, modo, cortes, memoria, confere) in enumerate(cenarios, 1):
+            r = await _cenario(server, diretorio, id, modo, cortes, tamanho, memoria)
+            ok = confere(r)
+            sucesso = sucesso and ok
+            print(
+                f"{nome:<15} {r['status']:<10} {len(r['requisicoes']):>5} "
+                f"{r['enviados'] / 2**20:>12.2f}  {'ok' if ok else 'FALHOU'}"
+            )
+        await server.fechar_http_client()
+    servidor.shutdown()
+    return sucesso
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--mb", type=int, default=8, help="tamanho do PDF em MB")
+    if not asyncio.run(_executar(parser.parse_args())):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()